@@ -3,8 +3,15 @@
 from .driver import GenericDriver
 from .driver import with_handler
 from .driver import with_lock
+from .event_loop import install_fast_event_loop
 from .generic_aqctl import get_controller_func
 
 __author__ = "Charles Baynham <charles.baynham@npl.co.uk>"
-__all__ = ["GenericDriver", "with_handler", "with_lock", "get_controller_func"]
+__all__ = [
+    "GenericDriver",
+    "with_handler",
+    "with_lock",
+    "get_controller_func",
+    "install_fast_event_loop",
+]
 __version__ = "1.6"
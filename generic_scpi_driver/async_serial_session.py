@@ -0,0 +1,260 @@
+"""
+A Session which talks to serial devices using non-blocking asyncio I/O
+
+This requires the optional ``pyserial-asyncio-fast`` package.
+"""
+
+import asyncio
+import logging
+import time
+from threading import Lock
+from threading import Thread
+
+from .session import Session
+from .visa_session import get_com_port_by_hwid
+
+logger = logging.getLogger(__name__)
+
+#: Timeout for responses if none is given, matching pyvisa's default [ms]
+DEFAULT_TIMEOUT = 2000
+
+_io_loop = None
+_io_loop_lock = Lock()
+
+
+def _get_io_loop():
+    """
+    Get the event loop which runs all serial I/O, starting it if needed
+
+    This loop runs in a daemon thread which is shared by all
+    AsyncSerialSessions, so waiting for a slow device never ties up a thread.
+    """
+    global _io_loop
+
+    with _io_loop_lock:
+        if _io_loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name="scpi-serial-io", daemon=True).start()
+            _io_loop = loop
+
+    return _io_loop
+
+
+class _SerialProtocol(asyncio.Protocol):
+    """
+    Buffers data received from a serial port so that it can be read line by line
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.buffer = bytearray()
+        self.data_received_event = asyncio.Event()
+        self.exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        self.data_received_event.set()
+
+    def connection_lost(self, exc):
+        self.exception = exc or ConnectionError("Serial connection closed")
+        self.data_received_event.set()
+
+    async def read_until(self, terminator: bytes) -> bytes:
+        while True:
+            index = self.buffer.find(terminator)
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[: index + len(terminator)]
+                return line
+
+            if self.exception:
+                raise self.exception
+
+            self.data_received_event.clear()
+            await self.data_received_event.wait()
+
+    async def read_exactly(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            if self.exception:
+                raise self.exception
+
+            self.data_received_event.clear()
+            await self.data_received_event.wait()
+
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def discard(self):
+        self.buffer.clear()
+        self.transport.serial.reset_input_buffer()
+
+
+class AsyncSerialSession(Session):
+    """
+    A Session for serial devices which doesn't block a thread while waiting for the device
+
+    All communication runs in a single background event loop, so coroutine
+    methods of a :class:`~GenericDriver` using this session await the device
+    directly instead of occupying an executor thread. The synchronous methods
+    still work, blocking the calling thread until the device responds.
+
+    Each request / response pair is protected by an :class:`asyncio.Lock`.
+    Coroutine methods using this session still take the driver's device lock
+    for each exchange, so they wait for e.g. :meth:`~GenericDriver.pipeline`
+    blocks in other threads, but only need a thread while the device is busy.
+    Responses time out after ``timeout`` ms, or
+    :data:`DEFAULT_TIMEOUT` if it isn't given.
+
+    Use this session by passing ``prefer_async_serial=True`` to the driver's
+    constructor.
+    """
+
+    supports_async = True
+
+    def __init__(
+        self,
+        id,
+        baud_rate,
+        read_termination="\n",
+        write_termination="\n",
+        timeout=None,
+        wait_after_connect=0.0,
+    ) -> None:
+        try:
+            import serial_asyncio_fast
+        except ImportError as e:
+            raise ImportError(
+                "AsyncSerialSession requires the pyserial-asyncio-fast package"
+            ) from e
+
+        if not read_termination:
+            raise ValueError("AsyncSerialSession requires a read_termination")
+
+        self._serial_asyncio = serial_asyncio_fast
+        self._read_termination = read_termination.encode()
+        self._write_termination = (write_termination or "").encode()
+
+        # Timeouts are in ms, to match VISASession. A device which never
+        # answers would otherwise hold the session's lock forever.
+        self._timeout = (timeout or DEFAULT_TIMEOUT) / 1000
+
+        port = get_com_port_by_hwid(id)
+        logger.debug("Found device %s on port %s", id, port)
+
+        self._loop = _get_io_loop()
+        self._run(self._connect(port, baud_rate))
+
+        if wait_after_connect:
+            time.sleep(wait_after_connect)
+
+        logger.debug('Device "%s" init complete', id)
+
+    async def _connect(self, port, baud_rate):
+        # The lock must be created in the I/O loop
+        self._lock = asyncio.Lock()
+        _, self._protocol = await self._serial_asyncio.create_serial_connection(
+            asyncio.get_running_loop(), _SerialProtocol, port, baudrate=baud_rate
+        )
+
+    def _run(self, coro):
+        """
+        Run a coroutine in the I/O loop and wait for the result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _await(self, coro):
+        """
+        Run a coroutine in the I/O loop and await the result from another loop
+        """
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, self._loop)
+        )
+
+    def _send(self, s: str):
+        self._protocol.transport.write(s.encode() + self._write_termination)
+
+    async def _receive(self) -> str:
+        line = await asyncio.wait_for(
+            self._protocol.read_until(self._read_termination), self._timeout
+        )
+        return line.decode()
+
+    async def _write(self, s: str, flush=False) -> None:
+        async with self._lock:
+            if flush:
+                self._protocol.discard()
+            self._send(s)
+
+    async def _query(self, s: str, flush=False) -> str:
+        async with self._lock:
+            if flush:
+                self._protocol.discard()
+            self._send(s)
+            return await self._receive()
+
+    async def _query_bytes(self, s: str, n: int) -> bytes:
+        async with self._lock:
+            self._send(s)
+            return await asyncio.wait_for(self._protocol.read_exactly(n), self._timeout)
+
+    async def _query_ieee_block(self, s: str) -> bytes:
+        async with self._lock:
+            self._send(s)
+            return await asyncio.wait_for(self._read_ieee_block(), self._timeout)
+
+    async def _read_ieee_block(self) -> bytes:
+        protocol = self._protocol
+
+        # Blocks are "#<number of digits in length><length><data>"
+        await protocol.read_until(b"#")
+        num_digits = int(await protocol.read_exactly(1))
+        if num_digits:
+            length = int(await protocol.read_exactly(num_digits))
+            data = await protocol.read_exactly(length)
+            await protocol.read_until(self._read_termination)
+        else:
+            # Blocks of indefinite length run until the termination character
+            data = await protocol.read_until(self._read_termination)
+
+        return data
+
+    async def _flush(self) -> None:
+        async with self._lock:
+            self._protocol.discard()
+
+    def write(self, s: str) -> None:
+        self._run(self._write(s))
+
+    def query(self, s: str) -> str:
+        return self._run(self._query(s))
+
+    def flush(self) -> None:
+        self._run(self._flush())
+
+    def flush_and_write(self, s: str) -> None:
+        self._run(self._write(s, flush=True))
+
+    def flush_and_query(self, s: str) -> str:
+        return self._run(self._query(s, flush=True))
+
+    def query_bytes(self, s: str, n: int) -> bytes:
+        return self._run(self._query_bytes(s, n))
+
+    def query_ieee_block(self, s: str) -> bytes:
+        return self._run(self._query_ieee_block(s))
+
+    async def write_async(self, s: str, flush=False) -> None:
+        await self._await(self._write(s, flush))
+
+    async def query_async(self, s: str, flush=False) -> str:
+        return await self._await(self._query(s, flush))
+
+    async def flush_async(self) -> None:
+        await self._await(self._flush())
+
+    def close(self) -> None:
+        self._loop.call_soon_threadsafe(self._protocol.transport.close)
@@ -8,13 +8,25 @@ This module can be used to generate a driver for a device which communicates wit
 import asyncio
 import logging
 import re
+import weakref
+from collections import OrderedDict
+from collections import deque
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
 from functools import wraps
+from inspect import Parameter
+from inspect import Signature
+from threading import Lock
 from threading import RLock
-from types import FunctionType
+from threading import local
 
+from .async_serial_session import AsyncSerialSession
+from .rwlock import GroupLock
+from .rwlock import RWLock
 from .session import Session
+from .session import SimulatorSession
 from .visa_session import VISASession
 
 logger = logging.getLogger("GenericSCPI")
@@ -22,33 +34,361 @@ logger = logging.getLogger("GenericSCPI")
 from typing import Callable
 from typing import Optional
 
-_locks = {}
-_sessions = {}
+_keyed_locks_index = Lock()
+_held = local()
 
 
-def with_lock(f):
+class _Device:
     """
-    Decorator to cause a function to acquire an RLock for this id before it runs.
+    Everything shared by the drivers for one device
+
+    These are created, modified and removed with _registry_lock held, except
+    for ``keyed_locks`` which is protected by _keyed_locks_index and
+    ``checked`` which is only ever a hint.
+    """
+
+    __slots__ = (
+        "lock",
+        "session",
+        "executor",
+        "keyed_locks",
+        "access",
+        "users",
+        "checked",
+        "pending_queries",
+    )
+
+    def __init__(self, session: Session, executor: ThreadPoolExecutor):
+        self.lock = RWLock()
+        self.session = session
+        self.executor = executor
+        # Locks for parts of the device, by resource key
+        self.keyed_locks = {}
+        # Keeps whole-device readers and keyed writers apart, while letting
+        # each of them run alongside others of their own kind
+        self.access = GroupLock()
+        # Number of live drivers using this device
+        self.users = 0
+        # True if the session has passed check_connection and no errors have
+        # occurred since, so new drivers don't need to check it again
+        self.checked = False
+        # Compound queries waiting to be sent, as
+        # (command, separator, validator, future, loop)
+        self.pending_queries = deque()
+
+
+# Devices with open sessions, and the devices which have no live drivers,
+# least recently used first. These are protected by _registry_lock. This is
+# reentrant because drivers release their sessions when they're garbage
+# collected, which can happen at any point.
+_devices = {}
+_idle_sessions = OrderedDict()
+_registry_lock = RLock()
+
+#: Default number of sessions to keep open for devices which no longer have
+#: any drivers. See :meth:`GenericDriver.set_cache_size`.
+DEFAULT_CACHED_SESSIONS = 16
+
+# The current limit, shared by all driver classes. Only changed by
+# GenericDriver.set_cache_size, with _registry_lock held.
+_max_cached_sessions: Optional[int] = DEFAULT_CACHED_SESSIONS
+
+_ARG_NAME_RE = re.compile(r"[A-Za-z_]\w*\Z")
+
+_DEFAULT_DOCSTRING = """Query "{}"
+
+This function is automatically generated. It will call the command "{}"
+and expects you to pass it {} arguments named {}."""
+
+
+def _close_device(dev_id):
+    """
+    Close the session for a device and forget everything stored about it
+
+    Must be called with _registry_lock held.
+    """
+    device = _devices.pop(dev_id, None)
+    _idle_sessions.pop(dev_id, None)
+
+    if device is not None:
+        device.executor.shutdown(wait=False)
+        device.session.close()
+
+
+def _evict_idle_sessions():
+    """
+    Close the least recently used idle sessions until there are few enough
+
+    Must be called with _registry_lock held.
+    """
+    if _max_cached_sessions is None:
+        return
+
+    while len(_idle_sessions) > _max_cached_sessions:
+        dev_id, _ = _idle_sessions.popitem(last=False)
+        logger.debug("Closing idle session for device %s", dev_id)
+        _close_device(dev_id)
+
+
+def _release_session(dev_id, device):
+    """
+    Called when a driver using this device is garbage collected
+    """
+    with _registry_lock:
+        # Do nothing if the session has already been closed
+        if _devices.get(dev_id) is not device:
+            return
+
+        device.users -= 1
+
+        if not device.users:
+            _idle_sessions[dev_id] = None
+            _evict_idle_sessions()
+
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_future_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def _normalise_resource_key(resource_key):
+    """
+    Convert a resource key into a sorted tuple of keys, or None for the whole device
+    """
+    if isinstance(resource_key, str):
+        resource_key = (resource_key,)
+
+    keys = tuple(sorted(set(resource_key)))
+
+    if not keys:
+        raise ValueError("resource_key must contain at least one key")
+
+    if "*" in keys:
+        return None
+
+    return keys
+
+
+def _get_keyed_locks(device, keys):
+    """
+    Get the locks for the given resource keys of a device, creating any that are missing
+    """
+    locks = device.keyed_locks
+    try:
+        return [locks[k] for k in keys]
+    except KeyError:
+        pass
+
+    # Only take the index lock if we need to create a new lock
+    with _keyed_locks_index:
+        return [locks.setdefault(k, RWLock()) for k in keys]
+
+
+def _get_held_locks():
+    """
+    Get the dict of device locks held by this thread, mapping dev_id to "read", "write" or "keyed"
+    """
+    try:
+        return _held.locks
+    except AttributeError:
+        _held.locks = {}
+        return _held.locks
+
+
+def _nesting_error(state, f):
+    """
+    Make the error for a locked function which can't be called from one holding ``state``
+    """
+    if state == "read":
+        reason = "a read-only function can't call one which writes to the device"
+    else:
+        reason = (
+            "a function with a resource_key can't call one which uses the whole "
+            "device. Give the outer function resource_key='*' instead"
+        )
+
+    return RuntimeError("Cannot call {}: {}".format(f.__name__, reason))
+
+
+def with_lock(f=None, *, mode="write", resource_key="*"):
+    """
+    Decorator to cause a function to acquire the lock for this id before it runs.
+
+    Locks are :class:`~generic_scpi_driver.rwlock.RWLock` objects stored in the
+    namespace of this module, shared by all drivers for the same device and
+    cached on each driver as ``self._lock``. By default the write side is acquired, giving
+    the function exclusive access to the device. Pass ``mode="read"`` for
+    functions which don't change the state of the device: these can run
+    concurrently with each other. Can be used either as ``@with_lock`` or as
+    ``@with_lock(mode="read")``.
+
+    Pass a ``resource_key`` (or a list of keys) to only lock part of the
+    device, e.g. ``"CH1"``. Functions with disjoint keys can run concurrently,
+    while functions sharing a key take turns. The default key of ``"*"``
+    overlaps every key, so functions which write to a key never run alongside
+    functions for the whole device, even read-only ones.
+
+    Locked functions can call each other, except that a read-only function
+    can't call one which writes, and a function with a ``resource_key`` can't
+    call one for the whole device. These raise a :class:`RuntimeError`.
 
-    RLocks are stored in the namespace of the class whose function is being decorated.
     Note that this decorator must be applied to a class method
     """
+    if mode not in ("read", "write"):
+        raise ValueError("mode must be 'read' or 'write', not '{}'".format(mode))
+
+    if f is None:
+        return partial(with_lock, mode=mode, resource_key=resource_key)
+
+    keys = _normalise_resource_key(resource_key)
+
+    if keys is None:
+        if mode == "read":
+
+            @wraps(f)
+            def wrapped(self: "GenericDriver", *args, **kw):
+                held = _get_held_locks()
+                state = held.get(self.dev_id)
+
+                # Nested calls can use the lock that we already hold
+                if state == "read" or state == "write":
+                    return f(self, *args, **kw)
+                if state == "keyed":
+                    raise _nesting_error(state, f)
+
+                lock = self._lock
+                access = self._device.access
+                lock.acquire_read()
+                try:
+                    access.acquire("read")
+                except BaseException:
+                    lock.release_read()
+                    raise
+                held[self.dev_id] = "read"
+                try:
+                    return f(self, *args, **kw)
+                finally:
+                    del held[self.dev_id]
+                    access.release()
+                    lock.release_read()
 
-    @wraps(f)
-    def wrapped(self: "GenericDriver", *args, **kw):
-        with _locks[self.dev_id]:
-            return f(self, *args, **kw)
+        else:
+
+            @wraps(f)
+            def wrapped(self: "GenericDriver", *args, **kw):
+                held = _get_held_locks()
+                state = held.get(self.dev_id)
+
+                if state == "write":
+                    return f(self, *args, **kw)
+                if state is not None:
+                    raise _nesting_error(state, f)
+
+                lock = self._lock
+                lock.acquire_write()
+                held[self.dev_id] = "write"
+                try:
+                    return f(self, *args, **kw)
+                finally:
+                    del held[self.dev_id]
+                    lock.release_write()
+
+    else:
+        read = mode == "read"
+
+        @wraps(f)
+        def wrapped(self: "GenericDriver", *args, **kw):
+            held = _get_held_locks()
+            state = held.get(self.dev_id)
+
+            # Holding the whole device means that nobody else can hold any
+            # keys, and whole-device readers already keep out keyed writers
+            if state == "write" or (state == "read" and read):
+                return f(self, *args, **kw)
+            if state == "read":
+                raise _nesting_error(state, f)
+
+            device_lock = self._lock
+            access = self._device.access
+            key_locks = _get_keyed_locks(self._device, keys)
+
+            # Share the device with other keyed functions, then take the keys
+            # in sorted order so that overlapping functions can't deadlock.
+            # Writers then wait for any whole-device readers to finish: this
+            # comes last so that it never waits while holding up other keys.
+            if state is None:
+                device_lock.acquire_read()
+                held[self.dev_id] = "keyed"
+            acquired = []
+            in_access = False
+            try:
+                for lock in key_locks:
+                    if read:
+                        lock.acquire_read()
+                    else:
+                        lock.acquire_write()
+                    acquired.append(lock)
+
+                if not read:
+                    access.acquire("keyed write")
+                    in_access = True
+
+                return f(self, *args, **kw)
+            finally:
+                if in_access:
+                    access.release()
+                for lock in reversed(acquired):
+                    if read:
+                        lock.release_read()
+                    else:
+                        lock.release_write()
+                if state is None:
+                    del held[self.dev_id]
+                    device_lock.release_read()
 
     wrapped.__name__ = f.__name__
     wrapped.__doc__ = f.__doc__
+    # Lets make_threaded_proxy know that this is safe to call from any thread
+    wrapped._takes_device_lock = True
 
     return wrapped
 
 
+def _recover_from_error(driver: "GenericDriver"):
+    """
+    Flush a device after an error, so that it's ready for the next command
+
+    Failures to flush are logged rather than raised so that they don't hide
+    the original error.
+    """
+    driver._device.checked = False
+    try:
+        driver.instr.flush()
+    except Exception:
+        logger.exception("Failed to flush device %s after an error", driver.dev_id)
+
+
+async def _recover_from_error_async(driver: "GenericDriver"):
+    """
+    Coroutine version of :func:`_recover_from_error` for async sessions
+    """
+    driver._device.checked = False
+    try:
+        await driver.instr.flush_async()
+    except Exception:
+        logger.exception("Failed to flush device %s after an error", driver.dev_id)
+
+
 def with_handler(f):
     """
     Decorator to wrap function in a try/except block, handling Exceptions by flush()ing the device,
-    then passing on the exception.
+    then passing on the exception. If the flush fails too, this is logged and
+    the original exception is still raised.
 
     This decorator expects the instance method self.instr.flush() to exit
     """
@@ -58,7 +398,7 @@ def with_handler(f):
         try:
             return f(self, *args, **kw)
         except Exception:
-            self.instr.flush()
+            _recover_from_error(self)
 
             raise
 
@@ -83,8 +423,32 @@ class GenericDriver:
     If you need more advanced logic in your driver, you can still just add
     methods as normal. They'll work side-by-side with methods registered by
     :meth:`GenericDriver._register_query`.
+
+    This class uses ``__slots__`` to keep drivers small and attribute access
+    fast. Subclasses can still store their own attributes as normal, but
+    should declare them in their own ``__slots__`` to keep these benefits.
     """
 
+    __slots__ = (
+        "dev_id",
+        "command_separator",
+        "simulation",
+        "instr",
+        "_executor",
+        "_lock",
+        "_device",
+        "_connected",
+        "_in_pipeline",
+        "_batch_buffer",
+        "_batch_separator",
+        "_batch_all",
+        "__weakref__",
+    )
+
+    #: Maximum number of queries registered with ``compound=True`` to combine
+    #: into one message
+    MAX_COMPOUND_QUERIES = 16
+
     session_factory: Callable[..., Session] = VISASession
     _simulator_factory: Optional[Callable[..., Session]] = None
 
@@ -95,6 +459,7 @@ class GenericDriver:
         simulation=False,
         baud_rate=57600,
         command_separator=" ",
+        prefer_async_serial=False,
         **kwargs,
     ):
         """Make a new device driver
@@ -107,12 +472,23 @@ class GenericDriver:
         and produces a string as output) then this driver can be run in
         simulation mode by passing ``simulation_mode=True`` to the constuctor.
 
+        If ``prefer_async_serial`` is true, the device is opened with an
+        :class:`~generic_scpi_driver.async_serial_session.AsyncSerialSession`
+        instead of the class's ``session_factory``. Coroutine methods will then
+        await the device directly instead of running in a thread. This requires
+        the ``pyserial-asyncio-fast`` package.
+
         Note that this constuctor ignores positional arguments: this means that
         it can be used with ARTIQ which passes the device manager into new
         driver constructors.
         """
         logger.debug("Creating new driver object for device %s", id)
 
+        self._connected = False
+        self._in_pipeline = False
+        self._batch_buffer = None
+        self._batch_separator = ";"
+        self._batch_all = False
         self.command_separator = command_separator
         self.simulation = simulation
 
@@ -123,65 +499,322 @@ class GenericDriver:
         if simulation:
             self.dev_id += "Sim"
 
-        logger.debug(
-            "Accessing controller {} with locks {}".format(self.dev_id, _locks)
-        )
+        logger.debug("Accessing controller %s", self.dev_id)
+
+        # Claim the registry while we set up this device, so that its session
+        # can't be created twice or closed while we're using it
+        with _registry_lock:
+            # Everything about this device lives in the namespace of this
+            # module and so is common across all Drivers, just in case you
+            # make multiple drivers pointing to the same device for some
+            # reason.
+            device = _devices.get(self.dev_id)
+            if device is None:
+                if simulation:
+                    if not self.__class__._simulator_factory:
+                        raise RuntimeError(
+                            "Simulation mode is not available: you must first call _register_simulator"
+                        )
+                    session = self.__class__._simulator_factory()
+                    if not isinstance(session, Session):
+                        session = SimulatorSession(session)
+                else:
+                    if prefer_async_serial:
+                        session_factory = AsyncSerialSession
+                    else:
+                        session_factory = self.__class__.session_factory
 
-        # Create a Lock for this resource if it doesn't already exist. This lives
-        # in the namespace of this module and so is common across all Drivers,
-        # just in case you make multiple drivers pointing to the same device for
-        # some reason
-        if self.dev_id not in _locks:
-            _locks[self.dev_id] = RLock()
-
-        # Claim this device exclusivly while we manipulate it
-        with _locks[self.dev_id]:
-            if simulation:
-                if not self.__class__._simulator_factory:
-                    raise RuntimeError(
-                        "Simulation mode is not available: you must first call _register_simulator"
-                    )
-                if self.dev_id not in _sessions:
-                    _sessions[self.dev_id] = self.__class__._simulator_factory()
-            else:
-                if self.dev_id not in _sessions:
                     # Pass all unrecognised keyword arguments to the session factory
-                    session = self.__class__.session_factory(
-                        id, baud_rate=baud_rate, **kwargs
-                    )
+                    session = session_factory(id, baud_rate=baud_rate, **kwargs)
                     session.flush()
 
-                    _sessions[self.dev_id] = session
-
-        self.check_connection()
-
-        logger.info(
-            "Controller {} successfully started and connected".format(self.dev_id)
-        )
+                # Coroutine methods run their I/O in a thread dedicated to
+                # this device, rather than competing for the device lock in
+                # the shared default executor
+                executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="scpi-{}".format(id)
+                )
+
+                device = _Device(session, executor)
+                _devices[self.dev_id] = device
+
+            # Each driver keeps references to the shared objects so that
+            # commands and @with_lock don't have to look them up. Other
+            # GenericDrivers can access the same session in a thread-safe
+            # way, taking turns via @with_lock.
+            self._device = device
+            self._lock = device.lock
+            self._executor = device.executor
+            self.instr: Session = device.session
+
+            # Keep the session open until this driver is closed or garbage collected
+            device.users += 1
+            _idle_sessions.pop(self.dev_id, None)
+            weakref.finalize(self, _release_session, self.dev_id, device)
+
+        # Sessions shared with earlier drivers have already been checked
+        if not device.checked:
+            self.check_connection()
+            device.checked = True
+        self._connected = True
+
+        logger.info("Controller %s successfully started and connected", self.dev_id)
 
     def close(self):
         """
         Close the connection to this device.
 
         After this method is called, no other methods will work and this object should be discarded.
+        The connection is shared by all drivers with the same ``id``, so they
+        can't be used afterwards either.
         """
         logger.debug("Closing connection to device %s", self.dev_id)
-        self.instr.close()
-        del _locks[self.dev_id]
-        del _sessions[self.dev_id]
+        with _registry_lock:
+            _close_device(self.dev_id)
+        self._connected = False
+        self.instr = None
+        self._executor = None
+
+    @contextmanager
+    def pipeline(self):
+        """Send several commands to the device while holding its lock
+
+        Inside a ``with driver.pipeline():`` block, the device lock is taken
+        once for all the commands instead of once per command, and the
+        communication buffers are flushed once at the start instead of before
+        every command registered with ``flush_before=True``. Other threads can't use the device until the block
+        exits. For example::
+
+            with dev.pipeline():
+                dev.set_voltage(1, 5.0)
+                dev.set_voltage(2, 3.0)
+                reading = dev.get_voltage(1)
+
+        Write-only commands registered with ``pipeline_with_next=True`` aren't
+        sent straight away inside a pipeline. Instead, they are joined with
+        ``;`` to the next write-only command and sent as one message. Any that
+        are still waiting are sent before the next query or when the block
+        exits, or discarded if the block raises an exception.
+        """
+        held = _get_held_locks()
+        state = held.get(self.dev_id)
+        already_held = state == "write"
+
+        if state is not None and not already_held:
+            raise _nesting_error(state, self.pipeline)
 
-    @property
-    def instr(self) -> Session:
+        if not already_held:
+            self._lock.acquire_write()
+            held[self.dev_id] = "write"
+
+        nested = self._in_pipeline
+        try:
+            if not nested:
+                self.instr.flush()
+                self._batch_buffer = []
+            self._in_pipeline = True
+
+            yield self
+
+            if not nested and self._batch_buffer:
+                self._send_batch()
+        finally:
+            self._in_pipeline = nested
+            if not nested:
+                self._batch_buffer = None
+
+            if not already_held:
+                del held[self.dev_id]
+                self._lock.release_write()
+
+    @contextmanager
+    def batch(self, separator=";"):
+        """Combine write-only commands into a single message
+
+        Inside a ``with driver.batch():`` block, registered commands with
+        ``response_parser=None`` aren't sent straight away. Instead, they are
+        joined with ``separator`` and sent as one message when the block
+        exits, using SCPI's support for compound commands. If a query is made
+        inside the block, the commands so far are sent first. If an exception
+        is raised inside the block, the remaining commands are discarded.
+
+        The block runs as a :meth:`pipeline`, so other threads can't use the
+        device until it exits. Note that SCPI interprets commands after a
+        ``;`` relative to the previous command's subsystem: pass
+        ``separator=";:"`` if your commands are full paths from the root.
         """
-        Get the session for this device.
+        with self.pipeline():
+            outer = self._batch_all
+            outer_separator = self._batch_separator
+            if not outer:
+                # Send anything left over from the pipeline first
+                if self._batch_buffer:
+                    self._send_batch()
+                self._batch_all = True
+                self._batch_separator = separator
+
+            try:
+                yield self
+
+                if not outer and self._batch_buffer:
+                    self._send_batch()
+            except BaseException:
+                # Discard this batch even if an outer pipeline carries on
+                if not outer:
+                    self._batch_buffer.clear()
+                raise
+            finally:
+                self._batch_all = outer
+                self._batch_separator = outer_separator
 
-        This is stored in a shared namespace for this python session,
-        so other GenericDrivers can access the same device in a thread-safe way, taking turns via @with_lock.
+    @with_handler
+    def _send_batch(self):
         """
-        logger.debug(
-            "Getting instrument object from _visa_sessions for device %s", self.dev_id
-        )
-        return _sessions[self.dev_id]
+        Send the commands collected by :meth:`batch` so far
+        """
+        cmd_string = self._batch_separator.join(self._batch_buffer)
+        self._batch_buffer.clear()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending batched commands '%s'", cmd_string)
+
+        self.instr.write(cmd_string)
+
+    def stream(self, method, calls):
+        """Call a query repeatedly, parsing each response while fetching the next
+
+        Each call to the device is made in the device's own thread, so the
+        device can be working on the next query while this thread parses the
+        previous response. This helps with long responses such as traces or
+        waveforms. For example::
+
+            for trace in dev.stream(dev.get_trace, [(1,), (2,), (3,)]):
+                process(trace)
+
+        Other threads can use the device between the calls.
+
+        Args:
+            method: A query registered with :meth:`_register_query`, e.g. ``dev.get_trace``
+            calls (iterable): The positional arguments for each call, as tuples
+
+        Yields:
+            The parsed response to each call, in order
+        """
+        try:
+            fetch, parse = getattr(method, "__func__", method)._stream
+        except AttributeError:
+            raise TypeError(
+                "{!r} is not a query registered with _register_query".format(method)
+            ) from None
+
+        calls = iter(calls)
+
+        if self.dev_id in _get_held_locks():
+            # The device's thread can't take the lock that this thread holds,
+            # e.g. in a pipeline, so fetch the responses here instead
+            for args in calls:
+                yield parse(fetch(self, args))
+            return
+
+        for args in calls:
+            pending = self._executor.submit(fetch, self, args)
+            break
+        else:
+            return
+
+        for args in calls:
+            r = pending.result()
+            pending = self._executor.submit(fetch, self, args)
+            yield parse(r)
+
+        yield parse(pending.result())
+
+    @with_lock
+    def _send_compound_queries(self):
+        """
+        Send waiting compound queries as one message and hand out the responses
+
+        This runs in the device's executor, so queries which arrive while the
+        device is busy are combined into the next message. Errors are passed
+        on to the waiting coroutines rather than raised.
+        """
+        pending = self._device.pending_queries
+
+        # An earlier call may have already sent these queries
+        if not pending:
+            return
+
+        # Only queries with the same separator can share a message. The others
+        # are left in order for the next call.
+        separator = pending[0][1]
+        queries = []
+        skipped = []
+        while pending and len(queries) < self.MAX_COMPOUND_QUERIES:
+            query = pending.popleft()
+            if query[1] == separator:
+                queries.append(query)
+            else:
+                skipped.append(query)
+        pending.extendleft(reversed(skipped))
+
+        commands = [q[0] for q in queries]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending compound query '%s'", separator.join(commands))
+
+        try:
+            responses = self.instr.query_many(commands, separator)
+        except Exception as e:
+            _recover_from_error(self)
+
+            for _, _, _, future, loop in queries:
+                loop.call_soon_threadsafe(_set_future_exception, future, e)
+            return
+
+        # Validate the responses here, with the lock held, so that failures
+        # are handled just like they are for other queries
+        errors = []
+        for (_, _, validator, _, _), response in zip(queries, responses):
+            try:
+                if validator:
+                    validator(response)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+
+        # Recover from any errors before the callers carry on
+        if any(errors):
+            _recover_from_error(self)
+
+        for (_, _, _, future, loop), response, error in zip(queries, responses, errors):
+            if error is None:
+                loop.call_soon_threadsafe(_set_future_result, future, response)
+            else:
+                loop.call_soon_threadsafe(_set_future_exception, future, error)
+
+    @staticmethod
+    def set_cache_size(n: Optional[int]):
+        """Set how many idle sessions to keep open
+
+        Sessions stay open while any driver is using them. Once all the
+        drivers for a device have been garbage collected, its session is kept
+        open so that new drivers for the same device can reuse it. Only the
+        ``n`` most recently used of these are kept: older ones are closed.
+        This applies to all drivers, whichever class it's called on. Defaults
+        to :data:`DEFAULT_CACHED_SESSIONS`.
+
+        Args:
+            n (int or None): Number of idle sessions to keep, or None for no limit
+        """
+        global _max_cached_sessions
+
+        if n is not None and n < 0:
+            raise ValueError("Cache size must not be negative")
+
+        with _registry_lock:
+            _max_cached_sessions = n
+            _evict_idle_sessions()
 
     @classmethod
     def _register_simulator(cls, simulator_factory):
@@ -212,6 +845,14 @@ class GenericDriver:
         args=[],
         coroutine=False,
         docstring=None,
+        read_only=False,
+        resource_key="*",
+        flush_before=False,
+        pipeline_with_next=False,
+        response_bytes=None,
+        response_ieee_binary=False,
+        compound=False,
+        compound_separator=";",
     ):
         """Make a function for this class which will access the device.
 
@@ -221,107 +862,337 @@ class GenericDriver:
             response_parser (callable, optional): Function to pass the response to. Must return a string. If not provided, the device's response will returned as a string. If set to None, the device's response will not be read.
             response_validator (callable, optional): Function to pass the response to before the parser. Can raise an error. Returns are ignored. Defaults to None.
             args (list, optional): List of arguments for the command, as ``GenericDriver.Arg`` objects. Defaults to [].
-            coroutine (bool, optional): If true, create an async coroutine instead of a normal method, wrapping serial calls in a threaded executor. Defaults to False.
+            coroutine (bool, optional): If true, create an async coroutine instead of a normal method, running serial calls in a thread dedicated to this device, or awaiting them directly if the session supports async I/O. Defaults to False.
             docstring (str, optional): Docstring for the created method.
+            read_only (bool, optional): If true, this command does not change the state of the device, so it only takes the read side of the device lock and can run concurrently with other read-only commands. Defaults to False.
+            resource_key (str or list, optional): Part(s) of the device that this command uses, e.g. "CH1". Commands with disjoint keys can run concurrently. Defaults to "*", meaning the whole device.
+            flush_before (bool, optional): If true, flush the communication buffers before sending this command, e.g. for devices which send unsolicited output. The buffers are always flushed if an error occurs. Defaults to False.
+            pipeline_with_next (bool, optional): If true, and this command doesn't read a response, then inside a :meth:`pipeline` it is held back and sent in one message with the next write-only command. Defaults to False.
+            response_bytes (int, optional): If set, read exactly this many bytes of response instead of reading up to the termination character. The response is passed to the validator and parser as bytes, and returned as bytes by default. Defaults to None.
+            response_ieee_binary (bool, optional): If true, read the response as an IEEE 488.2 binary block (``#<n><length><data>``). The data are passed to the validator and parser as bytes, and returned as bytes by default. Defaults to False.
+            compound (bool, optional): If true, calls to this coroutine which are waiting for the device are combined with those of other compound queries into one message, separated by ``compound_separator``, and the response split on ``;``. Only for queries whose responses never contain ``;``. Requires ``coroutine=True``, and can't be combined with ``flush_before``, ``read_only`` or ``resource_key`` since compound queries always lock the whole device. Defaults to False.
+            compound_separator (str, optional): Separator for compound queries. Only queries with the same separator are combined. Note that SCPI interprets commands after a ``;`` relative to the previous command's subsystem: pass ``";:"`` if your commands are full paths from the root. Defaults to ``";"``.
         """
         registered_args = [GenericDriver.Arg(*a) for a in args]
 
-        # Define a function that will be called with the arguments provided.
-        # This is guaranteed to get the right number of arguments with defaults
-        # already present because we will call it from a wrapper
-        @with_lock
-        @with_handler
-        def func(self: GenericDriver, *args):
-            arg_strings = []
-            for arg, registered_arg in zip(args, registered_args):
-                arg_strings.append(registered_arg.validator(arg))
+        # Split the arguments into plain tuples: Arg is only used to
+        # normalise the public API
+        names = tuple(arg.name for arg in registered_args)
+        defaults = tuple(arg.default for arg in registered_args)
+        validators = tuple(arg.validator for arg in registered_args)
 
-            cmd_string = self.command_separator.join([device_command] + arg_strings)
+        # Choose how to read responses which don't end in a termination character
+        if response_bytes or response_ieee_binary:
+            if response_bytes and response_ieee_binary:
+                raise ValueError(
+                    "Pass only one of response_bytes and response_ieee_binary"
+                )
+            if not response_parser:
+                raise ValueError("Commands with no response can't read bytes")
 
-            logger.debug("Sending command '%s'", cmd_string)
+        if response_bytes:
 
-            self.instr.flush()
+            def read_response(instr, cmd_string):
+                return instr.query_bytes(cmd_string, response_bytes)
 
-            if response_parser:
-                r = self.instr.query(cmd_string)
+        elif response_ieee_binary:
+
+            def read_response(instr, cmd_string):
+                return instr.query_ieee_block(cmd_string)
+
+        else:
+            read_response = None
+
+        # The raw bytes don't have a text encoding we can assume, so return
+        # them as they are unless asked to do something else
+        if read_response and response_parser is str:
+            response_parser = bytes
+
+        if compound and not (coroutine and response_parser and read_response is None):
+            raise ValueError(
+                "Compound queries must be coroutines which read a text response"
+            )
+        if compound and (flush_before or read_only or resource_key != "*"):
+            raise ValueError(
+                "Compound queries always lock the whole device and can't flush "
+                "first: don't pass flush_before, read_only or resource_key"
+            )
+
+        # Work out how to build the command string now, rather than on every
+        # call. Commands with no arguments don't build anything: see below.
+
+        if validators == (str,):
+            # The most common case: concatenate rather than building a list,
+            # and skip the default validator for arguments that are already
+            # strings
+
+            def build_command(separator, args):
+                arg = args[0]
+                if type(arg) is not str:
+                    arg = str(arg)
+                return device_command + separator + arg
 
-                # Validate the response if available
-                if response_validator:
-                    response_validator(r)
+        elif len(validators) == 1:
+            validator = validators[0]
 
-                # Return the parsed result
+            def build_command(separator, args):
+                return device_command + separator + validator(args[0])
+
+        elif len(validators) == 2:
+            # Unroll short argument lists rather than looping over them
+            v0, v1 = validators
+
+            def build_command(separator, args):
+                a0, a1 = args
+                return separator.join((device_command, v0(a0), v1(a1)))
+
+        elif len(validators) == 3:
+            v0, v1, v2 = validators
+
+            def build_command(separator, args):
+                a0, a1, a2 = args
+                return separator.join((device_command, v0(a0), v1(a1), v2(a2)))
+
+        elif all(v is str for v in validators):
+
+            def build_command(separator, args):
+                return separator.join([device_command, *map(str, args)])
+
+        else:
+
+            def build_command(separator, args):
+                return separator.join(
+                    [device_command, *[v(a) for v, a in zip(validators, args)]]
+                )
+
+        # Define a function that will be called with the complete command
+        # string. This is called from a wrapper which takes the arguments,
+        # validates them and builds the command. The error handling of
+        # @with_handler is written out here to save a function call. Only the
+        # exchange with the device holds the lock: the response is parsed
+        # afterwards so that slow parsers don't block other threads.
+        @with_lock(mode="read" if read_only else "write", resource_key=resource_key)
+        def exchange(self: GenericDriver, cmd_string):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending command '%s'", cmd_string)
+
+            instr = self.instr
+            try:
+                # Pipelines flush once at the start instead of before every command
+                flush = flush_before and not self._in_pipeline
+
+                if response_parser:
+                    # Queries need any batched commands to have been sent first
+                    if self._batch_buffer:
+                        self._send_batch()
+
+                    if read_response:
+                        if flush:
+                            instr.flush()
+                        r = read_response(instr, cmd_string)
+                    elif flush:
+                        r = instr.flush_and_query(cmd_string)
+                    else:
+                        r = instr.query(cmd_string)
+
+                    # Validate the response if available
+                    if response_validator:
+                        response_validator(r)
+
+                    return r
+                elif self._batch_buffer is not None and (
+                    pipeline_with_next or self._batch_all
+                ):
+                    self._batch_buffer.append(cmd_string)
+                elif self._batch_buffer:
+                    # Send this command along with those waiting for it
+                    self._batch_buffer.append(cmd_string)
+                    self._send_batch()
+                elif flush:
+                    instr.flush_and_write(cmd_string)
+                else:
+                    instr.write(cmd_string)
+            except Exception:
+                _recover_from_error(self)
+
+                raise
+
+        if response_parser:
+
+            def func(self: GenericDriver, cmd_string):
+                return response_parser(exchange(self, cmd_string))
+
+        else:
+            func = exchange
+
+        async def func_async(self, cmd_string):
+            if self.dev_id in _get_held_locks():
+                # This thread already holds the device, e.g. in a pipeline, so
+                # the device's thread couldn't take the lock. Run the command
+                # here, which also sends any batched commands first.
+                return func(self, cmd_string)
+
+            instr = self.instr
+            if (
+                read_response
+                or not instr.supports_async
+                or self._batch_buffer is not None
+                or not self._lock.try_acquire_write()
+            ):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, func, self, cmd_string
+                )
+
+            # Sessions with native async I/O don't need a thread if the device
+            # is free. The event loop's thread holds the device lock during the
+            # exchange so that other threads wait for it, just as they would
+            # for a command in the device's thread. Coroutines on this loop
+            # can still run alongside each other: the session keeps each
+            # exchange atomic.
+            try:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Sending command '%s'", cmd_string)
+
+                try:
+                    if response_parser:
+                        r = await instr.query_async(cmd_string, flush_before)
+
+                        if response_validator:
+                            response_validator(r)
+                    else:
+                        await instr.write_async(cmd_string, flush_before)
+                except Exception:
+                    await _recover_from_error_async(self)
+
+                    raise
+            finally:
+                self._lock.release_write()
+
+            if response_parser:
                 return response_parser(r)
-            else:
-                self.instr.write(cmd_string)
 
-        async def func_async(self, *args):
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, partial(func, self, *args))
+        if compound:
+
+            async def func_async(self, cmd_string):
+                if self.dev_id in _get_held_locks():
+                    # The device's thread couldn't take the lock that this
+                    # thread holds, so send the query on its own here
+                    return func(self, cmd_string)
+
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._device.pending_queries.append(
+                    (cmd_string, compound_separator, response_validator, future, loop)
+                )
+                self._executor.submit(self._send_compound_queries)
+
+                return response_parser(await future)
 
         logger.debug(
             "Registering method %s with coroutine = %s", method_name, coroutine
         )
 
-        # Build a python function which takes the arguments as named. This is useful because now our bound methods
-        # are real python methods, and so can respond to e.g.
-        #     obj.set_mode(1)
-        # or
-        #     obj.set_mode(mode=1)
-        # Also, python does the validation of number of args and setting of defaults for us
-        list_of_arg_names = ["self"]
-        for arg in registered_args:
-            if not re.match(r"^[\w_]+$", arg.name):
-                raise ValueError("'{}' is an invalid argument name".format(arg.name))
-            list_of_arg_names.append(arg.name)
-        all_arg_names = ", ".join(list_of_arg_names)
-
-        defaults = []
-        for arg in registered_args:
-            if arg.default:
-                defaults.append(arg.default)
+        if not names:
+            # Commands without arguments always send the same string, so
+            # there's nothing to build or validate
+            if coroutine:
+
+                async def wrapping_func(self):
+                    return await func_async(self, device_command)
+
             else:
-                if defaults:
+
+                def wrapping_func(self):
+                    return func(self, device_command)
+
+            wrapping_func.__name__ = method_name
+            wrapping_func.__qualname__ = method_name
+
+        else:
+            # Build a python function which takes the arguments as named. This is useful because now our bound methods
+            # are real python methods, and so can respond to e.g.
+            #     obj.set_mode(1)
+            # or
+            #     obj.set_mode(mode=1)
+            # The signature lets python do the validation of number of args
+            # and setting of defaults for us, and shows the arguments in help()
+            parameters = [Parameter("self", Parameter.POSITIONAL_OR_KEYWORD)]
+            seen_default = False
+            for name, default in zip(names, defaults):
+                if not _ARG_NAME_RE.match(name):
+                    raise ValueError("'{}' is an invalid argument name".format(name))
+
+                if default:
+                    seen_default = True
+                elif seen_default:
                     raise ValueError(
                         "You can't have arguments without defaults after arguments with defaults"
                     )
 
-        # Compile the wrapping function to call the one we already defined
-        if coroutine:
-            func_code_str = """async def wrapping_func({args}): return await func_async({args})""".format(
-                args=all_arg_names
-            )
-        else:
-            func_code_str = """def wrapping_func({args}): return func({args})""".format(
-                args=all_arg_names
-            )
+                parameters.append(
+                    Parameter(
+                        name,
+                        Parameter.POSITIONAL_OR_KEYWORD,
+                        default=default if default else Parameter.empty,
+                    )
+                )
 
-        wrapping_func_code = compile(func_code_str, "<string>", "exec")
+            signature = Signature(parameters)
+            num_args = len(names)
 
-        # Bind this wrapping code to create a function. Pass it the current
-        # context so that it can refer to func(). Also pass it the default
-        # values required.
-        wrapping_func = FunctionType(
-            wrapping_func_code.co_consts[0],
-            {**globals(), **locals()},
-            method_name,
-            tuple(defaults),
-        )
+            def bind_args(self, args, kwargs):
+                # Calls which pass every argument by position don't need binding
+                if kwargs or len(args) != num_args:
+                    bound = signature.bind(self, *args, **kwargs)
+                    bound.apply_defaults()
+                    args = bound.args[1:]
+                return args
 
-        # Add a doc string
-        if not docstring:
-            docstring = """
-Query "{}"
+            if coroutine:
 
-This function is automatically generated. It will call the command "{}"
-and expects you to pass it {} arguments named {}.
-        """.format(
-                method_name,
-                device_command,
-                len(args),
-                [arg.name for arg in registered_args],
-            ).strip()
+                async def wrapping_func(self, *args, **kwargs):
+                    args = bind_args(self, args, kwargs)
+                    return await func_async(
+                        self, build_command(self.command_separator, args)
+                    )
+
+            else:
+
+                def wrapping_func(self, *args, **kwargs):
+                    args = bind_args(self, args, kwargs)
+                    return func(self, build_command(self.command_separator, args))
 
-        wrapping_func.__doc__ = docstring
+            wrapping_func.__name__ = method_name
+            wrapping_func.__qualname__ = method_name
+            wrapping_func.__signature__ = signature
+
+        # Let stream() fetch responses separately from parsing them
+        if response_parser:
+            if names:
+
+                def fetch(self, args):
+                    args = bind_args(self, args, {})
+                    return exchange(self, build_command(self.command_separator, args))
+
+            else:
+
+                def fetch(self, args):
+                    if args:
+                        raise TypeError("{}() takes no arguments".format(method_name))
+                    return exchange(self, device_command)
+
+            wrapping_func._stream = (fetch, response_parser)
+
+        # Add a doc string, only generating one if none was given
+        if docstring:
+            wrapping_func.__doc__ = docstring
+        else:
+            wrapping_func.__doc__ = _DEFAULT_DOCSTRING.format(
+                method_name, device_command, len(names), list(names)
+            )
+
+        wrapping_func._takes_device_lock = True
 
         setattr(cls, method_name, wrapping_func)
 
@@ -330,7 +1201,11 @@ and expects you to pass it {} arguments named {}.
     def check_connection(self):
         """Check the connection to the device
 
-        You should override this method if you want checks in the setup
+        You should override this method if you want checks in the setup. It
+        is called when the first driver for a device is created, and again for
+        new drivers if an error has occurred on the device since. If
+        your checks only read from the device, decorate your override with
+        ``@with_lock(mode="read")`` so that it doesn't need exclusive access.
 
         Raises:
             Whatever errors you want to raise if the connection isn't working
@@ -342,8 +1217,12 @@ and expects you to pass it {} arguments named {}.
     def ping(self):
         """
         The all-important ping function, without which ARTIQ will brutally kill our controller.
+
+        This is called frequently, so it doesn't touch the device or its lock:
+        it just reports whether this driver has connected successfully and
+        hasn't been closed since.
         """
-        return True
+        return self._connected
 
 
 # _register_query(Driver, "get_identity", "*idn", response_validator=None)
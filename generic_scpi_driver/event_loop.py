@@ -0,0 +1,32 @@
+"""
+Optional acceleration of the asyncio event loop
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def install_fast_event_loop() -> bool:
+    """Use uvloop for asyncio event loops, if it is installed
+
+    This only helps if you make many concurrent calls to coroutine methods,
+    e.g. from an ARTIQ controller serving several clients: otherwise the time
+    spent in the event loop is tiny compared to talking to the device. Call
+    this before creating your event loop. Install uvloop with ``pip install
+    uvloop`` (not available on Windows).
+
+    Returns:
+        bool: True if uvloop was installed, False if the default loop is still in use
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not available: using the default asyncio event loop")
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using the uvloop event loop")
+
+    return True
@@ -1,13 +1,89 @@
 import argparse
 import asyncio
+import inspect
 import logging
+from functools import partial
+from functools import wraps
 
 from sipyco import common_args
 from sipyco.pc_rpc import Server
 
+from .event_loop import install_fast_event_loop
+
+
+def _run_in_thread(func, driver_obj):
+    """
+    Make a coroutine method which calls a blocking method of ``driver_obj`` in the loop's default executor
+    """
+
+    @wraps(func)
+    async def wrapped(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(func, driver_obj, *args, **kwargs)
+        )
+
+    # Show the original parameters, e.g. to sipyco's argument introspection,
+    # rather than *args and **kwargs
+    wrapped.__signature__ = inspect.signature(func)
+
+    return wrapped
+
+
+def make_threaded_proxy(driver_obj):
+    """
+    Make an object which exposes a driver's methods without blocking the event loop
+
+    Each public, synchronous method of the driver which takes the device lock,
+    i.e. the commands made by ``_register_query`` and methods decorated with
+    ``with_lock``, becomes a coroutine method which runs the original in a
+    thread. An RPC server can then handle other calls while it waits for the
+    device. Other methods aren't necessarily safe to run at the same time as
+    each other, so they're passed through unchanged, as are coroutine methods,
+    static methods and class methods.
+
+    Args:
+        driver_obj: The driver to wrap
+
+    Returns:
+        object: A proxy with the same public methods as the driver
+    """
+    cls = type(driver_obj)
+    namespace = {"__doc__": cls.__doc__}
+
+    for name in dir(cls):
+        if name.startswith("_"):
+            continue
+
+        # Look the methods up on the class so that properties aren't evaluated
+        func = inspect.getattr_static(cls, name)
+        if not (
+            inspect.isfunction(func) or isinstance(func, (staticmethod, classmethod))
+        ):
+            continue
+
+        method = getattr(driver_obj, name)
+
+        if (
+            inspect.isfunction(func)
+            and getattr(func, "_takes_device_lock", False)
+            and not asyncio.iscoroutinefunction(func)
+        ):
+            namespace[name] = _run_in_thread(func, driver_obj)
+        else:
+            # Keep the method bound to the driver, or its class
+            namespace[name] = staticmethod(method)
+
+    return type(cls.__name__, (), namespace)()
+
 
 def get_controller_func(
-    name, default_port, driver_class, driver_kwargs={}, extra_arg_processor=lambda _: []
+    name,
+    default_port,
+    driver_class,
+    driver_kwargs=None,
+    extra_arg_processor=lambda _: [],
+    run_in_threads=True,
 ):
     """
     Generate a function which will launch an ARTIQ controller for the provided class
@@ -18,41 +94,47 @@ def get_controller_func(
         name (str): The name of the controller.
         default_port (int): The default port number for the controller.
         driver_class (type): The class of the driver to be used.
-        driver_kwargs (dict, optional): Additional keyword arguments to pass to the driver class. Defaults to {}.
+        driver_kwargs (dict, optional): Additional keyword arguments to pass to the driver class. Defaults to None.
         extra_arg_processor (function, optional): Function that will be called and passed the ArgumentParser so that extra arguments can be added to the command line. Must return a list of strings of the names of the parameters added. . Defaults to a lambda that returns an empty list.
+        run_in_threads (bool, optional): If true, run the driver's synchronous methods which take the device lock in threads, so that they don't block the server while waiting for the device. See :func:`make_threaded_proxy`. Defaults to True.
     Returns:
         function: The main function for the controller.
     """
 
-    def main():
-        logging.getLogger(name).info("Launching controller %s", name)
+    def get_argparser():
+        parser = argparse.ArgumentParser(
+            description="Generic controller for {}".format(name)
+        )
+        group = parser.add_argument_group(name)
+        group.add_argument(
+            "--id",
+            required=True,
+            type=str,
+            help="VISA id to connect to. This Controller will obtain an exclusive lock.",
+        )
+        group.add_argument(
+            "--simulation",
+            action="store_true",
+            help="Run this controller in simulation mode. ID will be ignored but is still required.",
+        )
+        common_args.simple_network_args(parser, default_port)
+        common_args.verbosity_args(parser)
 
-        def get_argparser():
-            parser = argparse.ArgumentParser(
-                description="Generic controller for {}".format(name)
-            )
-            group = parser.add_argument_group(name)
-            group.add_argument(
-                "--id",
-                required=True,
-                type=str,
-                help="VISA id to connect to. This Controller will obtain an exclusive lock.",
-            )
-            group.add_argument(
-                "--simulation",
-                action="store_true",
-                help="Run this controller in simulation mode. ID will be ignored but is still required.",
-            )
-            common_args.simple_network_args(parser, default_port)
-            common_args.verbosity_args(parser)
+        # Call the extra arg processor to add any extra arguments to the command
+        # line. This will return a list of the arguments which were added
+        extra_args = extra_arg_processor(parser)
 
-            return parser
+        return parser, extra_args
 
-        args_parser = get_argparser()
+    # The parser is built on the first launch and reused after that
+    cached_parser = []
 
-        # Call the extra arg processor to add any extra arguments to the command
-        # line. This will return a list of the arguments which were added
-        extra_args = extra_arg_processor(args_parser)
+    def main():
+        logging.getLogger(name).info("Launching controller %s", name)
+
+        if not cached_parser:
+            cached_parser.append(get_argparser())
+        args_parser, extra_args = cached_parser[0]
 
         args = args_parser.parse_args()
         common_args.init_logger_from_args(args)
@@ -60,21 +142,25 @@ def get_controller_func(
         extra_arg_values = {k: getattr(args, k) for k in extra_args}
 
         # Merge driver_kwargs and extra_arg_values
-        merged_kwargs = {**driver_kwargs, **extra_arg_values}
+        merged_kwargs = {**(driver_kwargs or {}), **extra_arg_values}
 
         driver_obj = driver_class(
             None, id=args.id, simulation=args.simulation, **merged_kwargs
         )
 
-        loop = asyncio.get_event_loop()
-
         # Start an ARTIQ server for this device.
         #
         # Allow parallel connections so that functions which don't touch the
         # serial device can be done simultaneously: functions which do are
-        # protected by @with_lock.
+        # protected by @with_lock. Blocking functions run in threads so that
+        # they don't hold up the others.
+        if run_in_threads:
+            target = make_threaded_proxy(driver_obj)
+        else:
+            target = driver_obj
+
         server = Server(
-            {name: driver_obj},
+            {name: target},
             description="An automatically generated server for {}".format(
                 driver_class.__name__
             ),
@@ -82,22 +168,22 @@ def get_controller_func(
             allow_parallel=True,
         )
 
-        loop.run_until_complete(
-            server.start(
+        async def serve():
+            await server.start(
                 host=common_args.bind_address_from_args(args),
                 port=args.port,
             )
-        )
 
-        try:
-            loop.run_until_complete(server.wait_terminate())
-        finally:
             try:
-                loop.run_until_complete(server.stop())
+                await server.wait_terminate()
             finally:
-                # Close the VISA connection after the server has shutdown
-                driver_obj.close()
-
-            loop.close()
+                try:
+                    await server.stop()
+                finally:
+                    # Close the VISA connection after the server has shutdown
+                    driver_obj.close()
+
+        install_fast_event_loop()
+        asyncio.run(serve())
 
     return main
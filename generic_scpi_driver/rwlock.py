@@ -0,0 +1,181 @@
+"""
+Reentrant locks for sharing a device between threads
+"""
+
+from threading import Condition
+from threading import Lock
+from threading import get_ident
+
+
+class RWLock:
+    """
+    A reentrant readers-writer lock
+
+    Any number of threads may hold the read side at once, but the write side is
+    exclusive. Waiting writers block new readers so that a steady stream of
+    queries can't starve out commands.
+
+    Both sides are reentrant and a thread holding the write side may also take
+    the read side. A thread which only holds the read side cannot upgrade to the
+    write side: attempting this raises a :class:`RuntimeError` instead of
+    deadlocking.
+
+    For compatibility with :class:`threading.RLock`, using this object as a
+    context manager acquires the write side.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._writer = None
+        self._write_count = 0
+        self._readers = {}
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        me = get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_count += 1
+                return
+
+            if me in self._readers:
+                raise RuntimeError(
+                    "Cannot acquire the write lock while holding the read lock"
+                )
+
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+
+            self._writer = me
+            self._write_count = 1
+
+    def try_acquire_write(self):
+        """
+        Acquire the write side if that's possible without waiting
+
+        Returns:
+            bool: True if the write side was acquired
+        """
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_count += 1
+                return True
+
+            if self._writer is not None or self._readers or self._writers_waiting:
+                return False
+
+            self._writer = me
+            self._write_count = 1
+            return True
+
+    def release_write(self):
+        with self._cond:
+            if self._writer != get_ident():
+                raise RuntimeError("Cannot release a write lock that isn't held")
+
+            self._write_count -= 1
+            if not self._write_count:
+                self._writer = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release_write()
+
+
+class GroupLock:
+    """
+    A reentrant lock which is shared by the threads of one group at a time
+
+    Any number of threads may hold the lock for the same group, e.g.
+    ``"readers"``, but threads wanting a different group wait until they've all
+    released it. Threads waiting for another group block new arrivals, so
+    neither group can starve the other.
+
+    The lock is reentrant for the group a thread already holds. A thread
+    holding the lock for one group cannot acquire it for another: attempting
+    this raises a :class:`RuntimeError` instead of deadlocking.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._group = None
+        self._holders = {}
+        self._waiting = {}
+
+    def acquire(self, group):
+        me = get_ident()
+        with self._cond:
+            if me in self._holders:
+                if self._group != group:
+                    raise RuntimeError(
+                        "Cannot acquire the lock for {!r} while holding it for {!r}".format(
+                            group, self._group
+                        )
+                    )
+                self._holders[me] += 1
+                return
+
+            others_waiting = any(g != group for g in self._waiting)
+
+            if self._holders and (self._group != group or others_waiting):
+                self._waiting[group] = self._waiting.get(group, 0) + 1
+                try:
+                    # Once waiting, join as soon as our group holds the lock
+                    while self._holders and self._group != group:
+                        self._cond.wait()
+                finally:
+                    count = self._waiting[group] - 1
+                    if count:
+                        self._waiting[group] = count
+                    else:
+                        del self._waiting[group]
+
+            self._group = group
+            self._holders[me] = 1
+
+    def release(self):
+        me = get_ident()
+        with self._cond:
+            if me not in self._holders:
+                raise RuntimeError("Cannot release a lock that isn't held")
+
+            count = self._holders[me] - 1
+            if count:
+                self._holders[me] = count
+            else:
+                del self._holders[me]
+                if not self._holders:
+                    self._group = None
+                    self._cond.notify_all()
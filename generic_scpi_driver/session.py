@@ -1,3 +1,6 @@
+from typing import List
+
+
 class Session:
     """
     A Session that encapsulates communication with a device
@@ -6,8 +9,21 @@ class Session:
     the hardware connection to your device. You don't need to define a new type
     of Session unless your device uses a communication protocol that isn't
     already implemented by this package.
+
+    Sessions must be thread-safe. Commands registered with ``read_only`` or
+    ``resource_key`` only take part of the device lock, so the driver may call
+    these methods from several threads at once. Each call must be atomic: a
+    query's response must go to the thread which sent it, and one thread's
+    write must not be split by another's. :class:`~VISASession` does this by
+    holding a lock for each exchange.
     """
 
+    #: True if this Session implements :meth:`write_async`,
+    #: :meth:`query_async` and :meth:`flush_async`. Coroutine methods of the
+    #: driver will then await these instead of running the synchronous
+    #: methods in a thread.
+    supports_async = False
+
     def write(self, s: str) -> None:
         """
         Send a string to the device but do not expect a response
@@ -29,6 +45,92 @@ class Session:
         this function.
         """
 
+    def flush_and_write(self, s: str) -> None:
+        """
+        Flush any communication buffers, then send a string to the device
+
+        Sessions can override this if they can combine the two operations more
+        efficiently than calling :meth:`flush` followed by :meth:`write`.
+        """
+        self.flush()
+        self.write(s)
+
+    def flush_and_query(self, s: str) -> str:
+        """
+        Flush any communication buffers, then send a string to the device and expect a string response
+
+        Sessions can override this if they can combine the two operations more
+        efficiently than calling :meth:`flush` followed by :meth:`query`.
+        """
+        self.flush()
+        return self.query(s)
+
+    def query_many(self, commands: List[str], separator=";") -> List[str]:
+        """
+        Send several queries as one message and return a response for each
+
+        The commands are joined with ``separator`` into a compound SCPI
+        command, e.g. ``";:"`` for commands which are full paths from the
+        root. The single response is split on ``;``, which IEEE 488.2 always
+        uses between the responses to a compound query. This costs one round
+        trip instead of one per command. The responses must not contain ``;``
+        themselves.
+
+        Sessions can override this if their transport can do better.
+        """
+        cmd_string = separator.join(commands)
+        responses = self.query(cmd_string).split(";")
+
+        if len(responses) != len(commands):
+            raise RuntimeError(
+                "Expected {} responses to '{}' but got {}".format(
+                    len(commands), cmd_string, len(responses)
+                )
+            )
+
+        return responses
+
+    def query_bytes(self, s: str, n: int) -> bytes:
+        """
+        Send a string to the device and read exactly ``n`` bytes of response
+
+        Unlike :meth:`query`, this doesn't look for a termination character,
+        so it suits responses of a fixed length or which contain binary data.
+        """
+        raise NotImplementedError
+
+    def query_ieee_block(self, s: str) -> bytes:
+        """
+        Send a string to the device and read an IEEE 488.2 binary block response
+
+        These are of the form ``#<n><length><data>``. Returns the data only.
+        """
+        raise NotImplementedError
+
+    async def write_async(self, s: str, flush=False) -> None:
+        """
+        Coroutine version of :meth:`write`, flushing first if ``flush`` is true
+
+        Only used if :attr:`supports_async` is true.
+        """
+        raise NotImplementedError
+
+    async def query_async(self, s: str, flush=False) -> str:
+        """
+        Coroutine version of :meth:`query`, flushing first if ``flush`` is true
+
+        Only used if :attr:`supports_async` is true.
+        """
+        raise NotImplementedError
+
+    async def flush_async(self) -> None:
+        """
+        Coroutine version of :meth:`flush`
+
+        Only used if :attr:`supports_async` is true.
+        """
+        raise NotImplementedError
+
     def close(self) -> None:
         """
         Terminate communication with the device
@@ -37,3 +139,46 @@ class Session:
         should clean up any resources used, e.g. closing connections.
         """
         raise NotImplementedError
+
+
+class SimulatorSession(Session):
+    """
+    A Session which passes communication through to a simulator object
+
+    Simulators registered with :meth:`~GenericDriver._register_simulator` don't
+    need to inherit from :class:`Session`: they only need to implement the
+    methods that will actually be used, typically just ``query``. This class
+    wraps them so that the driver can treat them like any other Session. Other
+    attributes of the simulator are still available through this object.
+
+    Calls aren't serialised, so simulators used with ``read_only`` or
+    ``resource_key`` commands must be thread-safe too.
+    """
+
+    def __init__(self, simulator) -> None:
+        self.simulator = simulator
+
+    def write(self, s: str) -> None:
+        self.simulator.write(s)
+
+    def query(self, s: str) -> str:
+        return self.simulator.query(s)
+
+    def query_bytes(self, s: str, n: int) -> bytes:
+        return self.simulator.query_bytes(s, n)
+
+    def query_ieee_block(self, s: str) -> bytes:
+        return self.simulator.query_ieee_block(s)
+
+    def flush(self) -> None:
+        flush = getattr(self.simulator, "flush", None)
+        if flush:
+            flush()
+
+    def close(self) -> None:
+        close = getattr(self.simulator, "close", None)
+        if close:
+            close()
+
+    def __getattr__(self, name):
+        return getattr(self.simulator, name)
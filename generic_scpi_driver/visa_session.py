@@ -1,14 +1,171 @@
 import logging
 import re
 import time
+from functools import wraps
+from threading import Lock
 
 import pyvisa
-from serial.tools.list_ports import grep as grep_serial_ports
+from serial.tools.list_ports import comports
 
 from .session import Session
 
 logger = logging.getLogger(__name__)
 
+#: How long to remember the list of serial ports for [s]
+PORT_CACHE_TTL = 5.0
+
+# The last listing of serial ports, as (expiry time, [(port, description, hwid), ...])
+_port_listing = None
+
+#: Default size of the blocks that pyvisa reads from devices [bytes]. This is
+#: large so that long responses are read in one call.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+#: Number of encoded commands that each VISASession remembers
+ENCODED_COMMAND_CACHE_SIZE = 256
+
+# pyvisa-py doesn't have "COM" aliases for ASRL serial ports, so these are converted
+_COMPORT_RE = re.compile(r"^com(\d{1,3})$", re.IGNORECASE)
+
+# Flags for flushing every buffer of a VISA resource
+_DISCARD_ALL_BUFFERS = (
+    pyvisa.constants.VI_READ_BUF_DISCARD
+    | pyvisa.constants.VI_WRITE_BUF_DISCARD
+    | pyvisa.constants.VI_IO_IN_BUF_DISCARD
+    | pyvisa.constants.VI_IO_OUT_BUF_DISCARD
+)
+
+
+# A single ResourceManager is shared by all sessions, since creating one is
+# slow. It is closed when the last session using it closes.
+_resource_manager = None
+_resource_manager_users = 0
+_resource_manager_lock = Lock()
+
+
+def _get_resource_manager():
+    """
+    Get the shared pyvisa ResourceManager, creating it if needed
+
+    This counts the caller as a user of the ResourceManager, in the same step
+    so that it can't be closed in between: every call must be matched by a
+    call to :func:`_release_resource_manager`.
+    """
+    global _resource_manager, _resource_manager_users
+
+    with _resource_manager_lock:
+        if _resource_manager is None:
+            _resource_manager = pyvisa.ResourceManager("@py")
+        _resource_manager_users += 1
+
+        return _resource_manager
+
+
+def _release_resource_manager():
+    """
+    Record that a session has closed, closing the ResourceManager if it was the last
+    """
+    global _resource_manager, _resource_manager_users
+
+    with _resource_manager_lock:
+        _resource_manager_users -= 1
+        if _resource_manager_users or _resource_manager is None:
+            return
+
+        rm = _resource_manager
+        _resource_manager = None
+
+    logger.debug("Closing the VISA resource manager")
+    rm.close()
+
+
+def _list_ports():
+    """
+    List the serial ports as (port, description, hwid) tuples
+
+    Enumerating serial ports is slow, especially on Windows, so the listing is
+    reused by all lookups for PORT_CACHE_TTL.
+
+    Returns:
+        tuple: (ports, fresh) where fresh is False if the listing came from the cache
+    """
+    global _port_listing
+
+    now = time.monotonic()
+
+    listing = _port_listing
+    if listing is not None and listing[0] > now:
+        return listing[1], False
+
+    ports = [(p.device, p.description, p.hwid) for p in comports()]
+    _port_listing = (now + PORT_CACHE_TTL, ports)
+
+    return ports, True
+
+
+def clear_port_cache():
+    """
+    Forget the cached list of serial ports, e.g. because a device may have moved
+    """
+    global _port_listing
+    _port_listing = None
+
+
+def _clear_port_cache_on_error(f):
+    """
+    Decorator to clear the port cache if a VISA I/O error occurs
+
+    The device might have been unplugged, so the next connection should look
+    it up afresh.
+    """
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except pyvisa.VisaIOError:
+            clear_port_cache()
+            raise
+
+    return wrapped
+
+
+def _lookup_port_and_hwid(query):
+    """Find a single serial port matching a query, returning its port and HWID
+
+    Args:
+        query (str): Regular expression to match against the port names,
+            descriptions and HWIDs, like serial.tools.list_ports.grep
+
+    Raises:
+        RuntimeError: Raised if the device is not found or multiple matches are found
+
+    Returns:
+        tuple: (port, hwid) of the matching device
+    """
+    pattern = re.compile(query, re.IGNORECASE)
+
+    def find_matches(ports):
+        return [
+            (port, hwid)
+            for port, desc, hwid in ports
+            if pattern.search(port) or pattern.search(desc) or pattern.search(hwid)
+        ]
+
+    ports, fresh = _list_ports()
+    matches = find_matches(ports)
+
+    if not matches and not fresh:
+        # The device might have been plugged in since the ports were listed
+        clear_port_cache()
+        matches = find_matches(_list_ports()[0])
+
+    if not matches:
+        raise RuntimeError("Device {} not found".format(query))
+    if len(matches) > 1:
+        raise RuntimeError("Multiple matched for device {}".format(query))
+    return matches[0]
+
 
 def get_hwid_from_com_port(com_port):
     """Get a uniquely identifying HWID from a device attached to a COM port
@@ -26,12 +183,7 @@ def get_hwid_from_com_port(com_port):
     Returns:
         str: HWID of the device on the given COM port
     """
-    matches = list(grep_serial_ports(com_port))
-    if not matches:
-        raise RuntimeError("Device {} not found".format(com_port))
-    if len(matches) > 1:
-        raise RuntimeError("Multiple matched for device {}".format(com_port))
-    return matches[0].hwid
+    return _lookup_port_and_hwid(com_port)[1]
 
 
 def get_com_port_by_hwid(hwid):
@@ -43,7 +195,7 @@ def get_com_port_by_hwid(hwid):
 
     Args:
         hwid (str): Hardware ID string to match, e.g. 'USB VID:PID=0403:6001 SER=A6003SX4A'.
-                    This is matched using serial.tools.list_ports.grep so can be less specific
+                    This is matched like serial.tools.list_ports.grep so it can be less specific
                     if desired. The search should result in a single match otherwise an exception will
                     be raised.
 
@@ -53,12 +205,7 @@ def get_com_port_by_hwid(hwid):
     Returns:
         str: current port of the device (e.g. "COM11")
     """
-    matches = list(grep_serial_ports(hwid))
-    if not matches:
-        raise RuntimeError("Device {} not found".format(hwid))
-    if len(matches) > 1:
-        raise RuntimeError("Multiple matched for device {}".format(hwid))
-    return matches[0].device
+    return _lookup_port_and_hwid(hwid)[0]
 
 
 class VISASession(Session):
@@ -70,36 +217,59 @@ class VISASession(Session):
         write_termination="\n",
         timeout=None,
         wait_after_connect=0.0,
+        chunk_size=DEFAULT_CHUNK_SIZE,
     ) -> None:
-        self.visa_instr = self._setup_device(
-            id=id,
-            baud_rate=baud_rate,
-            read_termination=read_termination,
-            write_termination=write_termination,
-            timeout=timeout,
-            wait_after_connect=wait_after_connect,
-        )
+        # The driver's locks allow some commands to run concurrently, so make
+        # sure that their I/O doesn't get interleaved
+        self._io_lock = Lock()
+
+        rm = _get_resource_manager()
+        try:
+            self.visa_instr = self._setup_device(
+                rm,
+                id=id,
+                baud_rate=baud_rate,
+                read_termination=read_termination,
+                write_termination=write_termination,
+                timeout=timeout,
+                wait_after_connect=wait_after_connect,
+                chunk_size=chunk_size,
+            )
+        except BaseException:
+            _release_resource_manager()
+            raise
+
+        # Commands are encoded and terminated here rather than by pyvisa, so
+        # that repeated commands only need to be encoded once
+        self._encoded_commands = {}
+        self._write_termination = self.visa_instr.write_termination
+        self._encoding = self.visa_instr.encoding
 
     @staticmethod
     def _setup_device(
+        rm,
         id,
         baud_rate,
         read_termination="\n",
         write_termination="\n",
         timeout=None,
         wait_after_connect=0.0,
+        chunk_size=DEFAULT_CHUNK_SIZE,
     ):
         """Open a visa connection to the device
 
         Params:
+            rm - The shared pyvisa ResourceManager, from _get_resource_manager
             wait_after_connect - Time to wait after opening the connection before flushing it [s]
+            chunk_size - Size of the blocks that pyvisa reads from the device in [bytes].
+                Defaults to DEFAULT_CHUNK_SIZE (1 MiB). Pass None to use pyvisa's default.
 
         Raises:
             RuntimeError: Raised if VISA comms fail
 
         :rtype: :class:pyvisa.resources.Resource
         """
-        id_resolved = get_com_port_by_hwid(id)
+        id_resolved, hwid = _lookup_port_and_hwid(id)
 
         if id_resolved.lower() == id.lower():
             logger.warning(
@@ -108,26 +278,26 @@ class VISASession(Session):
                     'robust to use the HWID instead. For "%s", that\'s "%s"'
                 ),
                 id,
-                id_resolved,
+                hwid,
             )
 
         logger.debug("Found device %s on COM port %s", id, id_resolved)
 
-        # Get a handle to the instrument
-        rm = pyvisa.ResourceManager("@py")
-
-        logger.debug(f"Devices: {rm.list_resources()}")
+        # Listing resources enumerates every port, so only do it if it'll be seen
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Devices: %s", rm.list_resources())
 
         # pyvisa-py doesn't have "COM" aliases for ASRL serial ports, so convert
-        regex_match = re.match(r"^com(\d{1,3})$", id_resolved.lower())
+        regex_match = _COMPORT_RE.match(id_resolved)
         if regex_match:
             id_resolved = f"ASRL{regex_match[1]}"
 
-        logger.debug(f"Connecting to : {id_resolved}")
+        logger.debug("Connecting to : %s", id_resolved)
 
+        # Get a handle to the instrument
         instr = rm.open_resource(id_resolved)
 
-        logger.debug(f"Connection: {instr}")
+        logger.debug("Connection: %s", instr)
 
         # Configure the connection as required
 
@@ -145,6 +315,8 @@ class VISASession(Session):
             instr.write_termination = write_termination
         if timeout:
             instr.timeout = timeout
+        if chunk_size:
+            instr.chunk_size = chunk_size
         # instr.data_bits = 8
         # instr.stop_bits = pyvisa.constants.StopBits.one
         # instr.parity = pyvisa.constants.Parity.none
@@ -153,24 +325,74 @@ class VISASession(Session):
         if wait_after_connect:
             time.sleep(wait_after_connect)
 
-        logger.debug('Device "{}" init complete'.format(id))
+        logger.debug('Device "%s" init complete', id)
 
         return instr
 
+    def _encode(self, s: str) -> bytes:
+        try:
+            return self._encoded_commands[s]
+        except KeyError:
+            pass
+
+        if len(self._encoded_commands) >= ENCODED_COMMAND_CACHE_SIZE:
+            self._encoded_commands.clear()
+
+        encoded = (s + self._write_termination).encode(self._encoding)
+        self._encoded_commands[s] = encoded
+
+        return encoded
+
+    def _discard_buffers(self):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Flushing visa interface with device %s", self.visa_instr)
+        self.visa_instr.flush(_DISCARD_ALL_BUFFERS)
+
+    @_clear_port_cache_on_error
     def flush(self):
-        logger.debug("Flushing visa interface with device %s", self.visa_instr)
-        self.visa_instr.flush(
-            pyvisa.constants.VI_READ_BUF_DISCARD
-            | pyvisa.constants.VI_WRITE_BUF_DISCARD
-            | pyvisa.constants.VI_IO_IN_BUF_DISCARD
-            | pyvisa.constants.VI_IO_OUT_BUF_DISCARD
-        )
+        with self._io_lock:
+            self._discard_buffers()
 
+    @_clear_port_cache_on_error
     def write(self, s: str) -> None:
-        self.visa_instr.write(s)
+        with self._io_lock:
+            self.visa_instr.write_raw(self._encode(s))
 
+    @_clear_port_cache_on_error
     def query(self, s: str) -> str:
-        return self.visa_instr.query(s)
+        with self._io_lock:
+            self.visa_instr.write_raw(self._encode(s))
+            return self.visa_instr.read()
+
+    @_clear_port_cache_on_error
+    def flush_and_write(self, s: str) -> None:
+        with self._io_lock:
+            self._discard_buffers()
+            self.visa_instr.write_raw(self._encode(s))
+
+    @_clear_port_cache_on_error
+    def flush_and_query(self, s: str) -> str:
+        with self._io_lock:
+            self._discard_buffers()
+            self.visa_instr.write_raw(self._encode(s))
+            return self.visa_instr.read()
+
+    @_clear_port_cache_on_error
+    def query_bytes(self, s: str, n: int) -> bytes:
+        with self._io_lock:
+            self.visa_instr.write_raw(self._encode(s))
+            return self.visa_instr.read_bytes(n)
+
+    @_clear_port_cache_on_error
+    def query_ieee_block(self, s: str) -> bytes:
+        with self._io_lock:
+            # "s" unpacks the whole block as one bytes object, rather than
+            # making an int for every byte
+            return self.visa_instr.query_binary_values(s, datatype="s", container=bytes)
 
     def close(self) -> None:
-        self.visa_instr.close()
+        clear_port_cache()
+        try:
+            self.visa_instr.close()
+        finally:
+            _release_resource_manager()
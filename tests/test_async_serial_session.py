@@ -0,0 +1,173 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from generic_scpi_driver import GenericDriver
+
+pytest.importorskip("serial_asyncio_fast")
+pty = pytest.importorskip("pty")
+
+
+@pytest.fixture
+def fake_serial_device(monkeypatch):
+    """
+    A pseudo-terminal which answers "*IDN" and "ECHO <x>" queries
+    """
+    master, slave = pty.openpty()
+    port = os.ttyname(slave)
+    received = []
+
+    def respond():
+        buffer = b""
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.decode()
+                received.append(line)
+                if line == "*IDN":
+                    os.write(master, b"Fake device\n")
+                elif line == "BLK":
+                    os.write(master, b"#16hel\nlo\n")
+                elif line == "RAW":
+                    os.write(master, b"\n\x00ab")
+                elif line.startswith("ECHO "):
+                    os.write(master, line[5:].encode() + b"\n")
+
+    thread = threading.Thread(target=respond, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(
+        "generic_scpi_driver.async_serial_session.get_com_port_by_hwid",
+        lambda id: port,
+    )
+
+    yield received
+
+    os.close(master)
+    os.close(slave)
+
+
+class AsyncDriver(GenericDriver):
+    pass
+
+
+AsyncDriver._register_query("get_identity", "*IDN")
+AsyncDriver._register_query(
+    "get_identity_async", "*IDN", coroutine=True, flush_before=True
+)
+AsyncDriver._register_query(
+    "echo_async",
+    "ECHO",
+    args=[GenericDriver.Arg("value")],
+    coroutine=True,
+)
+AsyncDriver._register_query("set_async", "SET", response_parser=None, coroutine=True)
+AsyncDriver._register_query(
+    "set_first", "FIRST", response_parser=None, pipeline_with_next=True
+)
+AsyncDriver._register_query("get_nothing", "SILENT")
+
+
+def test_async_serial(fake_serial_device):
+    dev = AsyncDriver(id="async_serial", prefer_async_serial=True, timeout=2000)
+    try:
+        assert dev.instr.supports_async
+
+        assert dev.get_identity() == "Fake device"
+
+        async def run():
+            identity = await dev.get_identity_async()
+            await dev.set_async()
+            echoes = await asyncio.gather(*[dev.echo_async(i) for i in range(10)])
+            return identity, echoes
+
+        identity, echoes = asyncio.run(run())
+
+        assert identity == "Fake device"
+        assert echoes == [str(i) for i in range(10)]
+        assert "SET" in fake_serial_device
+    finally:
+        dev.close()
+
+
+def test_async_serial_binary(fake_serial_device):
+    dev = AsyncDriver(id="async_serial", prefer_async_serial=True, timeout=2000)
+    try:
+        assert dev.instr.query_ieee_block("BLK") == b"hel\nlo"
+        assert dev.instr.query_bytes("RAW", 4) == b"\n\x00ab"
+        assert dev.get_identity() == "Fake device"
+    finally:
+        dev.close()
+
+
+def test_async_serial_in_pipeline(fake_serial_device):
+    dev = AsyncDriver(id="async_serial", prefer_async_serial=True, timeout=2000)
+    try:
+        # Coroutine commands inside a pipeline go after the batched commands
+        with dev.pipeline():
+            dev.set_first()
+            asyncio.run(dev.set_async())
+
+        assert dev.get_identity() == "Fake device"
+        assert "FIRST;SET" in fake_serial_device
+    finally:
+        dev.close()
+
+
+def test_async_serial_waits_for_other_threads(fake_serial_device):
+    dev = AsyncDriver(id="async_serial", prefer_async_serial=True, timeout=2000)
+    # Another driver object sharing the device
+    other = AsyncDriver(id="async_serial", prefer_async_serial=True, timeout=2000)
+    assert other.instr is dev.instr
+    in_pipeline = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with other.pipeline():
+            in_pipeline.set()
+            release.wait(1)
+            other.set_first()
+
+    try:
+        thread = threading.Thread(target=hold)
+        thread.start()
+        assert in_pipeline.wait(1)
+
+        async def run():
+            task = asyncio.ensure_future(dev.echo_async("x"))
+            await asyncio.sleep(0.1)
+            assert not task.done()
+            release.set()
+            return await task
+
+        # Coroutine commands don't interrupt pipelines in other threads
+        assert asyncio.run(run()) == "x"
+        thread.join(1)
+        assert fake_serial_device.index("FIRST") < fake_serial_device.index("ECHO x")
+    finally:
+        release.set()
+        other.close()
+        dev.close()
+
+
+def test_async_serial_default_timeout(fake_serial_device, monkeypatch):
+    monkeypatch.setattr("generic_scpi_driver.async_serial_session.DEFAULT_TIMEOUT", 100)
+
+    dev = AsyncDriver(id="async_serial", prefer_async_serial=True)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            dev.get_nothing()
+
+        # The session isn't left locked
+        assert dev.get_identity() == "Fake device"
+    finally:
+        dev.close()
@@ -1,8 +1,16 @@
+import asyncio
+import gc
+import re
+import threading
 from unittest.mock import Mock
+from unittest.mock import call
 
 import pytest
 
 from generic_scpi_driver import GenericDriver
+from generic_scpi_driver import with_lock
+from generic_scpi_driver.driver import DEFAULT_CACHED_SESSIONS
+from generic_scpi_driver.driver import _get_held_locks
 
 
 def test_driver_class_creation():
@@ -308,3 +316,758 @@ def test_command_args_validators():
 
     d.get_mode(a=1.123)
     sim.query.assert_called_with("MODE? 1.1")
+
+
+def test_read_only_queries_run_concurrently():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_identity", "*IDN?", read_only=True)
+
+    # Both queries must be inside the simulator at the same time to pass the
+    # barrier
+    barrier = threading.Barrier(2, timeout=1)
+
+    def query(s):
+        barrier.wait()
+        return "Test device"
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(side_effect=query)
+
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="anything", simulation=True)
+
+    t = threading.Thread(target=d.get_identity)
+    t.start()
+    assert d.get_identity() == "Test device"
+    t.join()
+
+
+def test_resource_keys():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("set_ch1", "CH1", resource_key="CH1")
+    Driver._register_query("set_ch2", "CH2", resource_key="CH2")
+    Driver._register_query("reset", "*RST")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="anything", simulation=True)
+
+    # Commands with disjoint keys can be inside the simulator together
+    barrier = threading.Barrier(2, timeout=1)
+    sim.query = Mock(side_effect=lambda s: barrier.wait())
+
+    t = threading.Thread(target=d.set_ch1)
+    t.start()
+    d.set_ch2()
+    t.join()
+
+    # ...but a command for the whole device can't run alongside them
+    inside = threading.Event()
+    release = threading.Event()
+
+    def slow_query(s):
+        inside.set()
+        assert release.wait(1)
+
+    sim.query = Mock(side_effect=slow_query)
+
+    t = threading.Thread(target=d.set_ch1)
+    t.start()
+    assert inside.wait(1)
+
+    reset_done = threading.Event()
+    sim.query = Mock()
+    t_reset = threading.Thread(target=lambda: (d.reset(), reset_done.set()))
+    t_reset.start()
+    assert not reset_done.wait(0.1)
+
+    release.set()
+    t.join()
+    t_reset.join()
+    assert reset_done.is_set()
+
+
+def test_whole_device_reads_exclude_keyed_writes():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_all", "ALL?", read_only=True)
+    Driver._register_query("get_ch2", "CH2?", read_only=True, resource_key="CH2")
+    Driver._register_query("set_ch1", "CH1", resource_key="CH1")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="whole_device_reads", simulation=True)
+
+    inside = threading.Event()
+    release = threading.Event()
+
+    def slow_query(s):
+        if s == "ALL?":
+            inside.set()
+            assert release.wait(1)
+        return s
+
+    sim.query = Mock(side_effect=slow_query)
+
+    t = threading.Thread(target=d.get_all)
+    t.start()
+    assert inside.wait(1)
+
+    # Keyed reads can still run alongside the whole-device read...
+    assert d.get_ch2() == "CH2?"
+
+    # ...but keyed writes have to wait for it
+    set_done = threading.Event()
+    t_set = threading.Thread(target=lambda: (d.set_ch1(), set_done.set()))
+    t_set.start()
+    assert not set_done.wait(0.1)
+
+    release.set()
+    t.join()
+    t_set.join()
+    assert set_done.is_set()
+
+
+def test_nested_lock_errors():
+    class Driver(GenericDriver):
+        @with_lock(resource_key="CH1")
+        def set_ch1_then_reset(self):
+            self.set_ch1()
+            self.reset()
+
+        @with_lock(mode="read")
+        def get_then_reset(self):
+            self.get_identity()
+            self.reset()
+
+        @with_lock
+        def reset_then_set_ch1(self):
+            self.reset()
+            self.set_ch1()
+
+    Driver._register_query("get_identity", "*IDN?", read_only=True)
+    Driver._register_query("set_ch1", "CH1", resource_key="CH1")
+    Driver._register_query("reset", "*RST")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="nested_locks", simulation=True)
+
+    with pytest.raises(RuntimeError, match="resource_key"):
+        d.set_ch1_then_reset()
+
+    with pytest.raises(RuntimeError, match="read-only"):
+        d.get_then_reset()
+
+    # Functions for the whole device can call anything
+    d.reset_then_set_ch1()
+    sim.query.assert_called_with("CH1")
+
+
+def test_command_no_args():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_identity", "*IDN?")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    with pytest.raises(TypeError):
+        d.get_identity(1)
+
+    d.get_identity()
+    sim.query.assert_called_with("*IDN?")
+
+
+def test_coroutine():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_identity", "*IDN?", coroutine=True)
+    Driver._register_query("get_mode", "MODE?", args=[("a", None)], coroutine=True)
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(return_value="on")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    assert asyncio.run(d.get_identity()) == "on"
+    sim.query.assert_called_with("*IDN?")
+
+    assert asyncio.run(d.get_mode(1)) == "on"
+    sim.query.assert_called_with("MODE? 1")
+
+
+@pytest.mark.parametrize("name", ["1a", "a-b", "a b", "", "a\n"])
+def test_command_args_invalid_name(name):
+    class Driver(GenericDriver):
+        pass
+
+    with pytest.raises(ValueError):
+        Driver._register_query("get_mode", "MODE?", args=[(name, None)])
+
+
+def test_nested_locked_calls():
+    class Driver(GenericDriver):
+        def check_connection(self):
+            self.do_both()
+
+        @with_lock
+        def do_both(self):
+            self.get_identity()
+            self.get_status()
+
+    Driver._register_query("get_identity", "*IDN?", read_only=True)
+    Driver._register_query("get_status", "STAT?", resource_key="status")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+    d.do_both()
+    sim.query.assert_called_with("STAT?")
+
+
+def test_minimal_simulator():
+    class Simulator:
+        def query(self, s):
+            return "Simulator device" if s == "*IDN" else "ERROR"
+
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_simulator(Simulator)
+    Driver._register_query("get_identity", "*IDN")
+
+    d = Driver(id="something", simulation=True)
+
+    assert d.get_identity() == "Simulator device"
+    d.close()
+
+
+def test_idle_sessions_closed():
+    class Driver(GenericDriver):
+        pass
+
+    sims = []
+
+    def make_sim():
+        sims.append(Mock(unsafe=True))
+        return sims[-1]
+
+    Driver._register_simulator(make_sim)
+
+    try:
+        Driver.set_cache_size(1)
+
+        # Sessions stay open while their drivers are alive
+        a = Driver(id="a", simulation=True)
+        b = Driver(id="b", simulation=True)
+        Driver(id="a", simulation=True)
+        assert len(sims) == 2
+
+        # Idle sessions are kept up to the cache size...
+        del a
+        gc.collect()
+        sims[0].close.assert_not_called()
+
+        # ...after which the least recently used are closed
+        del b
+        gc.collect()
+        sims[0].close.assert_called_once()
+        sims[1].close.assert_not_called()
+
+        # A new driver reuses the idle session
+        Driver(id="b", simulation=True)
+        assert len(sims) == 2
+    finally:
+        Driver.set_cache_size(DEFAULT_CACHED_SESSIONS)
+
+
+def test_ping():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_simulator(lambda: Mock(unsafe=True))
+
+    d = Driver(id="something", simulation=True)
+    assert d.ping()
+
+    d.close()
+    assert not d.ping()
+
+
+def test_pipeline():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_mode", "MODE?", flush_before=True)
+    Driver._register_query(
+        "set_mode",
+        "MODE",
+        args=[("mode", None)],
+        response_parser=None,
+        flush_before=True,
+    )
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(return_value="on")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+    sim.flush.reset_mock()
+
+    with d.pipeline():
+        d.set_mode(1)
+        assert d.get_mode() == "on"
+
+    sim.flush.assert_called_once()
+    sim.write.assert_called_with("MODE 1")
+    sim.query.assert_called_with("MODE?")
+
+    # Commands flush as normal outside the pipeline
+    d.get_mode()
+    assert sim.flush.call_count == 2
+
+
+def test_flush_before():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_mode", "MODE?")
+    Driver._register_query("get_status", "STAT?", flush_before=True)
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+    sim.flush.reset_mock()
+
+    d.get_mode()
+    sim.flush.assert_not_called()
+
+    d.get_status()
+    sim.flush.assert_called_once()
+
+    # Errors always cause a flush
+    sim.query.side_effect = RuntimeError
+    with pytest.raises(RuntimeError):
+        d.get_mode()
+    assert sim.flush.call_count == 2
+
+
+def test_batch():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_mode", "MODE?")
+    Driver._register_query(
+        "set_mode", "MODE", args=[("mode", None)], response_parser=None
+    )
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(return_value="on")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    with d.batch():
+        d.set_mode(1)
+        d.set_mode(2)
+        sim.write.assert_not_called()
+
+        # Queries send the batch so far first
+        assert d.get_mode() == "on"
+        sim.write.assert_called_once_with("MODE 1;MODE 2")
+
+        d.set_mode(3)
+        d.set_mode(4)
+
+    sim.write.assert_called_with("MODE 3;MODE 4")
+    assert sim.write.call_count == 2
+
+    # Commands are discarded if the block raises
+    with pytest.raises(ValueError):
+        with d.batch():
+            d.set_mode(5)
+            raise ValueError
+    assert sim.write.call_count == 2
+
+    # ...even if the batch is inside a pipeline which carries on
+    with d.pipeline():
+        try:
+            with d.batch():
+                d.set_mode(1)
+                d.set_mode(2)
+                raise ValueError
+        except ValueError:
+            pass
+        d.set_mode(3)
+    sim.write.assert_called_with("MODE 3")
+    assert sim.write.call_count == 3
+
+
+def test_parser_runs_outside_lock():
+    class Driver(GenericDriver):
+        pass
+
+    held_while_parsing = []
+
+    def parser(s):
+        held_while_parsing.append(dict(_get_held_locks()))
+        return s
+
+    Driver._register_query("get_mode", "MODE?", response_parser=parser)
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(return_value="on")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+    assert d.get_mode() == "on"
+    assert held_while_parsing == [{}]
+
+
+def test_pipeline_with_next():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_mode", "MODE?")
+    Driver._register_query(
+        "set_mode",
+        "MODE",
+        args=[("mode", None)],
+        response_parser=None,
+        pipeline_with_next=True,
+    )
+    Driver._register_query("apply", "APPL", response_parser=None)
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(return_value="on")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    # Outside a pipeline, commands are sent straight away
+    d.set_mode(0)
+    sim.write.assert_called_once_with("MODE 0")
+
+    with d.pipeline():
+        d.set_mode(1)
+        d.set_mode(2)
+        assert sim.write.call_count == 1
+
+        # The next write-only command is sent along with the waiting ones
+        d.apply()
+        sim.write.assert_called_with("MODE 1;MODE 2;APPL")
+
+        d.set_mode(3)
+        assert d.get_mode() == "on"
+        sim.write.assert_called_with("MODE 3")
+
+        d.set_mode(4)
+
+    sim.write.assert_called_with("MODE 4")
+    assert sim.write.call_count == 4
+
+
+def test_binary_responses():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query("get_status", "STAT?", response_bytes=4)
+    Driver._register_query(
+        "get_name",
+        "NAME?",
+        response_bytes=4,
+        response_parser=lambda b: b.decode("latin-1"),
+    )
+    Driver._register_query("get_trace", "TRAC?", response_ieee_binary=True)
+    Driver._register_query(
+        "get_trace_length",
+        "TRAC?",
+        response_ieee_binary=True,
+        response_parser=len,
+    )
+
+    sim = Mock(unsafe=True)
+    sim.query_bytes = Mock(return_value=b"\xb51.0")
+    sim.query_ieee_block = Mock(return_value=b"\x00\x01\x02")
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    # Not valid UTF-8, so the raw bytes are returned unless the parser decodes them
+    assert d.get_status() == b"\xb51.0"
+    sim.query_bytes.assert_called_once_with("STAT?", 4)
+    assert d.get_name() == "\xb51.0"
+
+    assert d.get_trace() == b"\x00\x01\x02"
+    assert d.get_trace_length() == 3
+    sim.query_ieee_block.assert_called_with("TRAC?")
+    sim.query.assert_not_called()
+
+    with pytest.raises(ValueError):
+        Driver._register_query(
+            "bad", "BAD", response_bytes=4, response_ieee_binary=True
+        )
+
+
+def test_check_connection_once_per_session():
+    checks = []
+
+    class Driver(GenericDriver):
+        def check_connection(self):
+            checks.append(self)
+            self.get_identity()
+
+    Driver._register_query("get_identity", "*IDN?")
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d1 = Driver(id="something", simulation=True)
+    d2 = Driver(id="something", simulation=True)
+    assert checks == [d1]
+
+    # Errors mean that the session is checked again
+    sim.query.side_effect = RuntimeError
+    with pytest.raises(RuntimeError):
+        d2.get_identity()
+    sim.query.side_effect = None
+
+    d3 = Driver(id="something", simulation=True)
+    assert checks == [d1, d3]
+
+    # As do new sessions
+    d3.close()
+    d4 = Driver(id="something", simulation=True)
+    assert checks == [d1, d3, d4]
+
+
+def test_compound_queries():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query(
+        "get_mode",
+        "MODE?",
+        args=[("channel", None)],
+        response_parser=int,
+        coroutine=True,
+        compound=True,
+    )
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(side_effect=lambda s: ";".join(c[-1] for c in s.split(";")))
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    async def run():
+        # Hold up the device so that the queries have to wait
+        blocker = threading.Event()
+        d._executor.submit(blocker.wait)
+
+        tasks = [asyncio.ensure_future(d.get_mode(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        blocker.set()
+
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run()) == [0, 1, 2]
+    sim.query.assert_called_once_with("MODE? 0;MODE? 1;MODE? 2")
+
+    # Mismatched responses are an error
+    sim.query = Mock(return_value="1")
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+
+    with pytest.raises(ValueError):
+        Driver._register_query("get_status", "STAT?", compound=True)
+
+    for kwargs in [
+        {"flush_before": True},
+        {"read_only": True},
+        {"resource_key": "CH1"},
+    ]:
+        with pytest.raises(ValueError):
+            Driver._register_query(
+                "get_status", "STAT?", coroutine=True, compound=True, **kwargs
+            )
+
+
+def test_compound_separator():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query(
+        "get_mode",
+        "MODE?",
+        args=[("channel", None)],
+        coroutine=True,
+        compound=True,
+    )
+    Driver._register_query(
+        "get_freq",
+        "FREQ?",
+        args=[("channel", None)],
+        coroutine=True,
+        compound=True,
+        compound_separator=";:",
+    )
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(side_effect=lambda s: ";".join(c[-1] for c in re.split(";:?", s)))
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    async def run():
+        blocker = threading.Event()
+        d._executor.submit(blocker.wait)
+
+        tasks = [
+            asyncio.ensure_future(d.get_mode(0)),
+            asyncio.ensure_future(d.get_freq(1)),
+            asyncio.ensure_future(d.get_mode(2)),
+            asyncio.ensure_future(d.get_freq(3)),
+        ]
+        await asyncio.sleep(0)
+        blocker.set()
+
+        return await asyncio.gather(*tasks)
+
+    # Queries are only combined with others using the same separator
+    assert asyncio.run(run()) == ["0", "1", "2", "3"]
+    assert sim.query.call_args_list == [
+        call("MODE? 0;MODE? 2"),
+        call("FREQ? 1;:FREQ? 3"),
+    ]
+
+
+def test_compound_query_validation_flushes():
+    def check(r):
+        if r == "ERR":
+            raise RuntimeError("Device error")
+
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query(
+        "get_mode",
+        "MODE?",
+        response_validator=check,
+        coroutine=True,
+        compound=True,
+    )
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="compound_validation", simulation=True)
+    sim.flush.reset_mock()
+
+    sim.query = Mock(return_value="ERR")
+    with pytest.raises(RuntimeError, match="Device error"):
+        asyncio.run(d.get_mode())
+    sim.flush.assert_called_once()
+
+    sim.query = Mock(return_value="OK")
+    assert asyncio.run(d.get_mode()) == "OK"
+
+
+def test_slots():
+    class Driver(GenericDriver):
+        __slots__ = ("extra",)
+
+    Driver._register_simulator(lambda: Mock(unsafe=True))
+
+    d = Driver(id="something", simulation=True)
+    d.extra = 1
+    assert not hasattr(d, "__dict__")
+    with pytest.raises(AttributeError):
+        d.undeclared = 1
+
+
+def test_flush_failure_keeps_original_error():
+    class Driver(GenericDriver):
+        pass
+
+    def validator(s):
+        raise ValueError(s)
+
+    Driver._register_query("get_mode", "MODE?", response_validator=validator)
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+    sim.flush.side_effect = OSError
+
+    with pytest.raises(ValueError):
+        d.get_mode()
+    sim.flush.assert_called_once()
+
+
+def test_stream():
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query(
+        "get_trace", "TRAC?", args=[("channel", None)], response_parser=int
+    )
+    Driver._register_query("get_identity", "*IDN?")
+    Driver._register_query("set_mode", "MODE", response_parser=None)
+
+    sim = Mock(unsafe=True)
+    sim.query = Mock(side_effect=lambda s: s[-1])
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="something", simulation=True)
+
+    assert list(d.stream(d.get_trace, [(1,), (2,), (3,)])) == [1, 2, 3]
+    assert list(d.stream(d.get_trace, [])) == []
+    assert list(d.stream(d.get_identity, [(), ()])) == ["?", "?"]
+
+    # Streams work inside pipelines, which hold the device lock
+    with d.pipeline():
+        assert list(d.stream(d.get_trace, [(4,), (5,)])) == [4, 5]
+
+    with pytest.raises(TypeError):
+        list(d.stream(d.set_mode, [()]))
+
+
+@pytest.mark.parametrize("num_args", [2, 3, 4])
+def test_command_many_args(num_args):
+    class Driver(GenericDriver):
+        pass
+
+    Driver._register_query(
+        "set_values",
+        "VALS",
+        args=[("a{}".format(i), None, lambda x: str(x * 2)) for i in range(num_args)],
+        response_parser=None,
+    )
+
+    sim = Mock(unsafe=True)
+    Driver._register_simulator(lambda: sim)
+
+    d = Driver(id="many_args_{}".format(num_args), simulation=True)
+    d.set_values(*range(num_args))
+    sim.write.assert_called_once_with(
+        " ".join(["VALS"] + [str(i * 2) for i in range(num_args)])
+    )
@@ -0,0 +1,23 @@
+import asyncio
+import sys
+from unittest.mock import Mock
+
+from generic_scpi_driver import install_fast_event_loop
+
+
+def test_without_uvloop(monkeypatch):
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    assert not install_fast_event_loop()
+
+
+def test_with_uvloop(monkeypatch):
+    uvloop = Mock()
+    uvloop.EventLoopPolicy = asyncio.DefaultEventLoopPolicy
+    monkeypatch.setitem(sys.modules, "uvloop", uvloop)
+
+    policy = asyncio.get_event_loop_policy()
+    try:
+        assert install_fast_event_loop()
+        assert asyncio.get_event_loop_policy() is not policy
+    finally:
+        asyncio.set_event_loop_policy(policy)
@@ -1,26 +1,30 @@
+import asyncio
+import inspect
+import threading
+from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
 import pytest
 
+from generic_scpi_driver import GenericDriver
+from generic_scpi_driver import with_lock
 from generic_scpi_driver.generic_aqctl import get_controller_func
+from generic_scpi_driver.generic_aqctl import make_threaded_proxy
 
 
 @pytest.fixture
 def mock_server():
     with patch("generic_scpi_driver.generic_aqctl.Server") as MockServer:
-        yield MockServer
+        server = MockServer.return_value
+        server.start = AsyncMock()
+        server.wait_terminate = AsyncMock()
+        server.stop = AsyncMock()
+        with patch("generic_scpi_driver.generic_aqctl.install_fast_event_loop"):
+            yield MockServer
 
 
-@pytest.fixture
-def mock_event_loop():
-    with patch("asyncio.get_event_loop") as mock_loop:
-        mock_loop.return_value.run_until_complete = MagicMock()
-        mock_loop.return_value.close = MagicMock()
-        yield mock_loop
-
-
-def test_main(mock_server, mock_event_loop):
+def test_main(mock_server):
     name = "test_controller"
     default_port = 1234
     driver_kwargs = {}
@@ -61,5 +65,90 @@ def test_main(mock_server, mock_event_loop):
             driver_class.assert_called_with(
                 None, id="test_id", simulation=True, extra="extra_value"
             )
-            mock_event_loop.return_value.run_until_complete.assert_called()
-            mock_event_loop.return_value.close.assert_called()
+            mock_server.return_value.start.assert_awaited_once()
+            mock_server.return_value.wait_terminate.assert_awaited_once()
+            mock_server.return_value.stop.assert_awaited_once()
+            driver_class.return_value.close.assert_called_once()
+
+
+def test_threaded_proxy():
+    class Driver(GenericDriver):
+        def where(self):
+            return threading.current_thread()
+
+        @with_lock
+        def where_locked(self):
+            return threading.current_thread()
+
+        @with_lock
+        def scale(self, x, factor=2):
+            return x * factor
+
+        @staticmethod
+        def static_answer():
+            return 42
+
+        @classmethod
+        def class_name(cls):
+            return cls.__name__
+
+        @property
+        def broken(self):
+            raise ValueError("Properties shouldn't be evaluated")
+
+    Driver._register_query("get_identity", "*IDN?")
+    Driver._register_query("get_identity_async", "*IDN?", coroutine=True)
+
+    sim = MagicMock()
+    sim.query.return_value = "Sim"
+    Driver._register_simulator(lambda: sim)
+
+    proxy = make_threaded_proxy(Driver(id="something", simulation=True))
+
+    async def call_and_get_thread(method):
+        return (await method()), threading.current_thread()
+
+    assert inspect.ismethod(proxy.get_identity)
+    assert proxy.ping() is True
+    assert asyncio.run(proxy.get_identity()) == "Sim"
+    assert asyncio.run(proxy.get_identity_async()) == "Sim"
+    assert not hasattr(proxy, "_register_query")
+    assert not hasattr(proxy, "broken")
+
+    # Only methods which take the device lock run in other threads
+    assert proxy.where() is threading.current_thread()
+    worker, loop_thread = asyncio.run(call_and_get_thread(proxy.where_locked))
+    assert worker is not loop_thread
+
+    # Threaded methods keep their parameters for introspection
+    assert str(inspect.signature(proxy.scale)) == "(x, factor=2)"
+    assert inspect.getfullargspec(proxy.scale).args == ["self", "x", "factor"]
+    assert asyncio.run(proxy.scale(3, factor=4)) == 12
+    assert asyncio.iscoroutinefunction(proxy.scale)
+
+    assert proxy.static_answer() == 42
+    assert proxy.class_name() == "Driver"
+
+
+def test_argparser_reused(mock_server):
+    driver_class = MagicMock()
+    driver_class.__name__ = "TestDriver"
+
+    def extra_arg_processor(parser):
+        parser.add_argument("--extra", type=str)
+        return ["extra"]
+
+    extra_arg_processor = MagicMock(side_effect=extra_arg_processor)
+
+    main_func = get_controller_func(
+        "test_controller", 1234, driver_class, extra_arg_processor=extra_arg_processor
+    )
+
+    for value in ["a", "b"]:
+        with patch("sys.argv", ["prog", "--id", "test_id", "--extra", value]):
+            main_func()
+        driver_class.assert_called_with(
+            None, id="test_id", simulation=False, extra=value
+        )
+
+    extra_arg_processor.assert_called_once()
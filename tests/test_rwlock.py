@@ -0,0 +1,134 @@
+import threading
+
+import pytest
+
+from generic_scpi_driver.rwlock import GroupLock
+from generic_scpi_driver.rwlock import RWLock
+
+
+def test_readers_share():
+    lock = RWLock()
+    barrier = threading.Barrier(2, timeout=1)
+
+    def reader():
+        lock.acquire_read()
+        try:
+            barrier.wait()
+        finally:
+            lock.release_read()
+
+    t = threading.Thread(target=reader)
+    t.start()
+    reader()
+    t.join()
+
+
+def test_writer_excludes_readers():
+    lock = RWLock()
+    acquired = threading.Event()
+
+    def reader():
+        lock.acquire_read()
+        acquired.set()
+        lock.release_read()
+
+    with lock:
+        t = threading.Thread(target=reader)
+        t.start()
+        assert not acquired.wait(0.1)
+
+    assert acquired.wait(1)
+    t.join()
+
+
+def test_reentrancy():
+    lock = RWLock()
+
+    with lock:
+        with lock:
+            lock.acquire_read()
+            lock.release_read()
+
+    lock.acquire_read()
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_read()
+
+
+def test_no_upgrade():
+    lock = RWLock()
+
+    lock.acquire_read()
+    with pytest.raises(RuntimeError):
+        lock.acquire_write()
+    lock.release_read()
+
+
+def test_try_acquire_write():
+    lock = RWLock()
+    results = []
+
+    def other():
+        results.append(lock.try_acquire_write())
+
+    # Fails while another thread holds either side, without waiting
+    lock.acquire_read()
+    t = threading.Thread(target=other)
+    t.start()
+    t.join(1)
+    lock.release_read()
+
+    with lock:
+        t = threading.Thread(target=other)
+        t.start()
+        t.join(1)
+
+        # ...but is reentrant
+        assert lock.try_acquire_write()
+        lock.release_write()
+
+    assert results == [False, False]
+
+    assert lock.try_acquire_write()
+    lock.release_write()
+
+
+def test_group_lock():
+    lock = GroupLock()
+    barrier = threading.Barrier(2, timeout=1)
+    acquired = threading.Event()
+
+    def member(group):
+        lock.acquire(group)
+        try:
+            barrier.wait()
+        finally:
+            lock.release()
+
+    # Threads in the same group share the lock
+    t = threading.Thread(target=member, args=("a",))
+    t.start()
+    member("a")
+    t.join()
+
+    # Other groups wait
+    def other():
+        lock.acquire("b")
+        acquired.set()
+        lock.release()
+
+    lock.acquire("a")
+    lock.acquire("a")
+    t = threading.Thread(target=other)
+    t.start()
+    assert not acquired.wait(0.1)
+
+    with pytest.raises(RuntimeError):
+        lock.acquire("b")
+
+    lock.release()
+    assert not acquired.wait(0.1)
+    lock.release()
+
+    assert acquired.wait(1)
+    t.join()
@@ -0,0 +1,164 @@
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from pyvisa.util import from_ieee_block
+
+from generic_scpi_driver import visa_session
+
+
+@pytest.fixture
+def mock_comports():
+    visa_session.clear_port_cache()
+    ports = [
+        Mock(
+            device="COM3", description="USB Serial", hwid="USB VID:PID=0403:6001 SER=A1"
+        ),
+        Mock(device="COM4", description="Bluetooth", hwid="BTHENUM"),
+    ]
+    with patch(
+        "generic_scpi_driver.visa_session.comports", return_value=ports
+    ) as mock_comports:
+        yield mock_comports
+    visa_session.clear_port_cache()
+
+
+def test_port_lookup_cached(mock_comports):
+    assert visa_session.get_com_port_by_hwid("SER=A1") == "COM3"
+    assert visa_session.get_com_port_by_hwid("SER=A1") == "COM3"
+    mock_comports.assert_called_once()
+
+    visa_session.clear_port_cache()
+    assert visa_session.get_com_port_by_hwid("SER=A1") == "COM3"
+    assert mock_comports.call_count == 2
+
+
+def test_port_lookup_failure_not_cached(mock_comports):
+    mock_comports.return_value = []
+    with pytest.raises(RuntimeError):
+        visa_session.get_com_port_by_hwid("SER=A1")
+    with pytest.raises(RuntimeError):
+        visa_session.get_com_port_by_hwid("SER=A1")
+    assert mock_comports.call_count == 2
+
+
+def test_resource_manager_shared():
+    with patch("generic_scpi_driver.visa_session._resource_manager", None), patch(
+        "pyvisa.ResourceManager"
+    ) as mock_rm:
+        rm = visa_session._get_resource_manager()
+        assert visa_session._get_resource_manager() is rm
+        mock_rm.assert_called_once_with("@py")
+
+        visa_session._release_resource_manager()
+        rm.close.assert_not_called()
+        visa_session._release_resource_manager()
+        rm.close.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "port,match", [("COM3", "3"), ("com12", "12"), ("/dev/ttyUSB0", None)]
+)
+def test_comport_regex(port, match):
+    m = visa_session._COMPORT_RE.match(port)
+    assert (m[1] if m else None) == match
+
+
+@pytest.fixture
+def mock_session():
+    instr = Mock(write_termination="\r\n", encoding="ascii")
+    instr.read = Mock(return_value="response")
+    with patch(
+        "generic_scpi_driver.visa_session._resource_manager", Mock()
+    ), patch.object(visa_session.VISASession, "_setup_device", return_value=instr):
+        session = visa_session.VISASession("COM3", baud_rate=9600)
+        yield session
+        session.close()
+
+
+def test_commands_encoded_once(mock_session):
+    instr = mock_session.visa_instr
+
+    mock_session.write("A")
+    instr.write_raw.assert_called_once_with(b"A\r\n")
+
+    assert mock_session.query("A") == "response"
+    first, second = instr.write_raw.call_args_list
+    assert first[0][0] is second[0][0]
+
+
+def test_port_and_hwid_share_lookup(mock_comports):
+    assert visa_session.get_com_port_by_hwid("COM3") == "COM3"
+    assert visa_session.get_hwid_from_com_port("COM3") == "USB VID:PID=0403:6001 SER=A1"
+    mock_comports.assert_called_once()
+
+
+def test_resource_manager_closed_with_last_session():
+    rm = Mock()
+    instr = Mock(write_termination="\n", encoding="ascii")
+    with patch("generic_scpi_driver.visa_session._resource_manager", rm), patch.object(
+        visa_session.VISASession, "_setup_device", return_value=instr
+    ):
+        s1 = visa_session.VISASession("COM3", baud_rate=9600)
+        s2 = visa_session.VISASession("COM4", baud_rate=9600)
+
+        s1.close()
+        rm.close.assert_not_called()
+
+        s2.close()
+        rm.close.assert_called_once()
+        assert visa_session._resource_manager is None
+
+
+def test_query_many(mock_session):
+    instr = mock_session.visa_instr
+    instr.read.return_value = "1;2;3"
+
+    assert mock_session.query_many(["A?", "B?", "C?"]) == ["1", "2", "3"]
+    instr.write_raw.assert_called_once_with(b"A?;B?;C?\r\n")
+
+    with pytest.raises(RuntimeError):
+        mock_session.query_many(["A?", "B?"])
+
+    # The responses are separated by ";" whatever joins the commands
+    instr.write_raw.reset_mock()
+    instr.read.return_value = "1;2"
+    assert mock_session.query_many(["A?", "B?"], ";:") == ["1", "2"]
+    instr.write_raw.assert_called_once_with(b"A?;:B?\r\n")
+
+
+def test_port_listing_shared(mock_comports):
+    assert visa_session.get_com_port_by_hwid("SER=A1") == "COM3"
+    assert visa_session.get_com_port_by_hwid("bthenum") == "COM4"
+    assert visa_session.get_hwid_from_com_port("COM4") == "BTHENUM"
+    mock_comports.assert_called_once()
+
+    with pytest.raises(RuntimeError):
+        visa_session.get_com_port_by_hwid("COM")
+
+
+def test_resource_manager_released_if_setup_fails():
+    rm = Mock()
+    with patch("generic_scpi_driver.visa_session._resource_manager", rm), patch.object(
+        visa_session.VISASession, "_setup_device", side_effect=RuntimeError
+    ):
+        with pytest.raises(RuntimeError):
+            visa_session.VISASession("COM3", baud_rate=9600)
+
+        rm.close.assert_called_once()
+
+
+def test_ieee_block_read_as_bytes(mock_session):
+    data = bytes(range(256)) * 4096
+    block = b"#7" + str(len(data)).encode() + data
+
+    # Parse the block with pyvisa, using the arguments that the session passes
+    instr = mock_session.visa_instr
+    instr.query_binary_values.side_effect = lambda s, **kwargs: from_ieee_block(
+        block, **kwargs
+    )
+
+    assert mock_session.query_ieee_block("CURV?") == data
+
+    # The block is unpacked in one go, not byte by byte
+    assert instr.query_binary_values.call_args.kwargs["datatype"] == "s"